@@ -7,29 +7,48 @@
 # The script fails with an error message and a non-zero exit code,
 # when there are any errors in the input that need attention
 #
-# Usage: 1-validate.py
+# Usage: 1-validate.py [--incremental]
+# - Validates all player definitions
+# - Only validates player definitions that changed since the last successful
+#   validation, when --incremental is passed, using the state in
+#   /.cache/validate.json, which is discarded when the code or schemas change
 #
 
+import argparse
 import dataclasses
 import enum
+import hashlib
+import json
 import jsonschema
 import os
 import pathlib
+import re
 import sys
-import warnings
-from collections import defaultdict
+from typing import Iterable, Optional
 
 import core
 from core import log, error
 
-# ignore jsonschema warnings for now
-warnings.filterwarnings("ignore", category=DeprecationWarning)
-
 SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "src")
 PLAYERS_DIR = os.path.join(SRC_DIR, "players")
-SCHEMA_PATH = os.path.join(SRC_DIR, "schemas")
-PLAYER_SCHEMA_FILE = os.path.join(SCHEMA_PATH, "player.schema.json")
-PLAYER_SCHEMA = core.read_json(PLAYER_SCHEMA_FILE)
+PLAYER_SCHEMA = "player.schema.json"
+MANIFEST_FILE = os.path.join(core.ROOT_DIR, ".cache", "validate.json")
+MANIFEST_VERSION = 1
+# the prefix and the instance suffixes that clients strip from D-Bus service
+# identifiers, only the text inside a capture group of a suffix is stripped,
+# see "MPRIS on Linux" in api/specification.md
+MPRIS_SERVICE_PREFIX = "org.mpris.MediaPlayer2."
+MPRIS_SUFFIX_PATTERNS = [
+    re.compile(f"{pattern}$")
+    for pattern in [
+        r"(\.(i|I)nstance[-_\d]*)",
+        r"(\.(p|P)layer[\d]*)",
+        r"(\.mpris[_aA-fF0-9]+)",
+        r"(\.profile[_aA-fF0-9]+)",
+        r"\.GSConnect(\.[^\.\s]+)",
+        r"\.mpd(\.[^\.\s]+)",
+    ]
+]
 
 
 class PlayerCategory(enum.Enum):
@@ -87,54 +106,59 @@ class ValidationTarget:
 
 
 def get_targets(root: str) -> dict[str, ValidationTarget]:
+    return read_targets(root, get_target_paths(root))
+
+
+def get_target_paths(root: str) -> list[pathlib.Path]:
     for path in pathlib.Path(root).rglob("*.yml"):
         path = path.relative_to(root)
         error(f"YAML definitions must end with the .yaml extension: {path}")
-    targets: dict[str, ValidationTarget] = {}
-    for path in pathlib.Path(root).rglob("*.yaml"):
+    paths = list(pathlib.Path(root).rglob("*.yaml"))
+    ids: dict[str, pathlib.Path] = {}
+    for path in paths:
         relative_path = path.relative_to(root)
         directory = os.path.dirname(relative_path)
         if len(directory) == 0:
             error(f"YAML definitions must be in a subdirectory: {relative_path}")
         if len(os.path.dirname(directory)) > 0:
             error(f"Nested directories are not allowed: {relative_path}")
-        target_path = path.resolve()
+        if path.stem in ids:
+            other_relative_path = ids[path.stem].relative_to(root)
+            error(f"Duplicate ID: {relative_path} and {other_relative_path}")
+        ids[path.stem] = path
+    return paths
+
+
+def read_targets(root: str, paths: list[pathlib.Path]) -> dict[str, ValidationTarget]:
+    contents = core.read_yaml_corpus([path.resolve() for path in paths])
+    targets: dict[str, ValidationTarget] = {}
+    for path, content in zip(paths, contents):
         target = ValidationTarget(
-            path=target_path,
-            category_from_directory=directory,
+            path=path.resolve(),
+            category_from_directory=os.path.dirname(path.relative_to(root)),
             id_from_filename=path.stem,
-            content=core.read_yaml(target_path),
+            content=content,
         )
-        if target.id_from_filename in targets:
-            other_path = targets[target.id_from_filename].path
-            other_relative_path = pathlib.Path(other_path).relative_to(root)
-            error(f"Duplicate ID: {relative_path} and {other_relative_path}")
         targets[target.id_from_filename] = target
     return targets
 
 
 def validate_target(target: ValidationTarget):
-    if target.category_from_directory not in [c.value for c in PlayerCategory]:
-        message = f"{target.category_from_directory} for {target.short_path}"
-        error(f"Player category not recognized: {message}")
-    validate_target_schema(target, PLAYER_SCHEMA)
-    if target.content["id"] != target.id_from_filename:
-        a = f'"{target.content["id"]}"'
-        b = f'"{target.id_from_filename}" in {target.short_path}'
-        error(f"Mismatching player ID: {a} and {b}")
-    validate_target_category_invariants(target)
-
-
-def validate_target_schema(target: ValidationTarget, schema: any):
+    with core.span(target.id_from_filename, "player"):
+        if target.category_from_directory not in [c.value for c in PlayerCategory]:
+            message = f"{target.category_from_directory} for {target.short_path}"
+            error(f"Player category not recognized: {message}")
+        validate_target_schema(target, PLAYER_SCHEMA)
+        if target.content["id"] != target.id_from_filename:
+            a = f'"{target.content["id"]}"'
+            b = f'"{target.id_from_filename}" in {target.short_path}'
+            error(f"Mismatching player ID: {a} and {b}")
+        validate_target_category_invariants(target)
+
+
+def validate_target_schema(target: ValidationTarget, schema: str):
     try:
-        jsonschema.validate(
-            instance=target.content,
-            schema=schema,
-            resolver=jsonschema.RefResolver(
-                base_uri=f"{pathlib.Path(SCHEMA_PATH).as_uri()}/",
-                referrer=PLAYER_SCHEMA,
-            ),
-        )
+        core.validate_with_schema(target.content, schema)
     except jsonschema.ValidationError as e:
         error(f"Schema validation error:\n\nFile {target.path}:\n\n{e}")
 
@@ -303,45 +327,79 @@ def validate_target_category_invariants(target: ValidationTarget):
             )
 
 
-def validate_cross_target_invariants(targets: dict[str, ValidationTarget]):
-    discord_application_ids = dict()
-    source_platform_ids = defaultdict(dict)
-    for player_id, target in targets.items():
-        if "represents" in target.content:
-            for other_id in target.content["represents"]:
+class CrossTargetIndex:
+    """
+    Indexes of the values that must be unique across all players
+    and of the players that other players represent.
+    Players are added and removed one by one, so that the index can be kept
+    and updated with the players that changed, instead of being rebuilt.
+    """
+
+    def __init__(self, state: Optional[dict] = None):
+        if state is None:
+            state = {}
+        # the values of each player, so that they can be removed again
+        self.players: dict[str, dict] = state.get("players", {})
+        self.discord_application_ids: dict[str, str] = state.get(
+            "discord_application_ids", {}
+        )
+        self.source_identifiers: dict[str, dict[str, str]] = state.get(
+            "source_identifiers", {}
+        )
+        self.represented_by: dict[str, list[str]] = state.get("represented_by", {})
+        # the identifiers as clients compare them, after normalization
+        self.normalized_identifiers: dict[str, dict[str, str]] = state.get(
+            "normalized_identifiers", {}
+        )
+        # basenames of paths, which clients compare next to the full path
+        self.identifier_basenames: dict[str, dict[str, list[str]]] = state.get(
+            "identifier_basenames", {}
+        )
+        # MPRIS matchers with more than a service identifier,
+        # which take priority over matchers with only the service identifier
+        self.mpris_matchers: dict[str, str] = state.get("mpris_matchers", {})
+
+    def state(self) -> dict:
+        return {
+            "players": self.players,
+            "discord_application_ids": self.discord_application_ids,
+            "source_identifiers": self.source_identifiers,
+            "represented_by": self.represented_by,
+            "normalized_identifiers": self.normalized_identifiers,
+            "identifier_basenames": self.identifier_basenames,
+            "mpris_matchers": self.mpris_matchers,
+        }
+
+    def add(self, player_id: str, content: dict) -> None:
+        assert player_id not in self.players
+        entry = {
+            "represents": [],
+            "discord_application_id": None,
+            "source_identifiers": [],
+            "normalized_identifiers": [],
+            "identifier_basenames": [],
+            "mpris_matchers": [],
+        }
+        if "represents" in content:
+            for other_id in content["represents"]:
                 if other_id == player_id:
                     error(f'Player "{player_id}" may not represent itself')
-                if other_id not in targets:
-                    error(
-                        f'Player "{player_id}" represents non-existent player "{other_id}"'
-                    )
-
-                # FIXME Allow nested "represents" relationships for now.
-                # These should not be allowed in theory, but nested relationships
-                # are needed for placeholders to be accepted. Music Presence
-                # currently does not read these recursively, so it's okay for now.
-                # They should never be read recursively.
-
-                # other = targets[other_id]
-                # if "represents" in other.content:
-                #     error(
-                #         f'Player "{player_id}" cannot represent "{other_id}" '
-                #         f'because "{other_id}" already represents other players'
-                #     )
-        if (
-            "extra" in target.content
-            and "discord_application_id" in target.content["extra"]
-        ):
-            discord_application_id = target.content["extra"]["discord_application_id"]
-            if discord_application_id in discord_application_ids:
+                entry["represents"].append(other_id)
+        if "extra" in content and "discord_application_id" in content["extra"]:
+            discord_application_id = content["extra"]["discord_application_id"]
+            if discord_application_id in self.discord_application_ids:
                 error(
                     f'Player "{player_id}" has a Discord application ID that is already '
-                    f'used by "{discord_application_ids[discord_application_id]}"'
+                    f'used by "{self.discord_application_ids[discord_application_id]}"'
                 )
-            discord_application_ids[discord_application_id] = player_id
-        if "sources" in target.content:
+            self.discord_application_ids[discord_application_id] = player_id
+            entry["discord_application_id"] = discord_application_id
+        if "sources" in content:
             # TODO Move this to a different method later
-            for source_name, platform_ids in target.content["sources"].items():
+            for source_name, platform_ids in content["sources"].items():
+                source_platform_ids = self.source_identifiers.setdefault(
+                    source_name, {}
+                )
                 for platform_id in platform_ids:
                     save_platform_id = True
                     if isinstance(platform_id, dict):
@@ -351,6 +409,7 @@ def validate_cross_target_invariants(targets: dict[str, ValidationTarget]):
                                 # with other properties, so it's allowed to appear
                                 # across multiple media player definitions.
                                 save_platform_id = False
+                                self._add_mpris_matcher(player_id, platform_id, entry)
                             # FIXME Don't hardcode "service" here
                             platform_id = platform_id["service"]
                     if not isinstance(platform_id, str):
@@ -359,36 +418,284 @@ def validate_cross_target_invariants(targets: dict[str, ValidationTarget]):
                             f'for platform "{source_name}" must be a string'
                         )
                     if save_platform_id:
-                        if platform_id in source_platform_ids[source_name]:
+                        if platform_id in source_platform_ids:
                             error(
                                 f'Player "{player_id}" shares source identifier '
                                 f'"{platform_id}" with '
-                                f'"{source_platform_ids[source_name][platform_id]}" '
+                                f'"{source_platform_ids[platform_id]}" '
                                 f'for platform "{source_name}"'
                             )
-                        source_platform_ids[source_name][platform_id] = player_id
+                        source_platform_ids[platform_id] = player_id
+                        entry["source_identifiers"].append([source_name, platform_id])
+                        self._add_normalized_identifier(
+                            player_id, source_name, platform_id, entry
+                        )
+        for other_id in entry["represents"]:
+            self.represented_by.setdefault(other_id, []).append(player_id)
+        self.players[player_id] = entry
+
+    def _add_normalized_identifier(
+        self, player_id: str, source_name: str, identifier: str, entry: dict
+    ) -> None:
+        # identifiers collide when any of their forms are equal,
+        # or when one is equal to the basename of a path of another
+        forms, basenames = normalized_identifier(source_name, identifier)
+        owners = self.normalized_identifiers.setdefault(source_name, {})
+        basename_owners = self.identifier_basenames.setdefault(source_name, {})
+
+        def collision_error(form: str, other_id: str):
+            error(
+                f'Player "{player_id}" has source identifier "{identifier}" '
+                f'that collides with "{other_id}" for platform "{source_name}", '
+                f'both match "{form}"'
+            )
+
+        for form in forms:
+            other_id = owners.get(form, player_id)
+            if other_id != player_id:
+                collision_error(form, other_id)
+            for other_id in basename_owners.get(form, []):
+                if other_id != player_id:
+                    collision_error(form, other_id)
+        for basename in basenames:
+            other_id = owners.get(basename, player_id)
+            if other_id != player_id:
+                collision_error(basename, other_id)
+        for form in forms:
+            if form not in owners:
+                owners[form] = player_id
+                entry["normalized_identifiers"].append([source_name, form])
+        for basename in basenames:
+            players = basename_owners.setdefault(basename, [])
+            if player_id not in players:
+                players.append(player_id)
+                entry["identifier_basenames"].append([source_name, basename])
+
+    def _add_mpris_matcher(self, player_id: str, matcher: dict, entry: dict) -> None:
+        key = "\n".join(
+            (
+                f"{name}={normalized_identifier(SourceName.LIN_MPRIS.value, value)[0][0]}"
+                if name == "service"
+                else f"{name}={value}"
+            )
+            for name, value in sorted(matcher.items())
+        )
+        other_id = self.mpris_matchers.get(key, player_id)
+        if other_id != player_id:
+            error(
+                f'Player "{player_id}" has an MPRIS matcher that collides '
+                f'with "{other_id}": {matcher}'
+            )
+        if key not in self.mpris_matchers:
+            self.mpris_matchers[key] = player_id
+            entry["mpris_matchers"].append(key)
+
+    def remove(self, player_id: str) -> None:
+        entry = self.players.pop(player_id)
+        for other_id in entry["represents"]:
+            self.represented_by[other_id].remove(player_id)
+            if len(self.represented_by[other_id]) == 0:
+                del self.represented_by[other_id]
+        if entry["discord_application_id"] is not None:
+            del self.discord_application_ids[entry["discord_application_id"]]
+        for source_name, platform_id in entry["source_identifiers"]:
+            del self.source_identifiers[source_name][platform_id]
+        for source_name, form in entry["normalized_identifiers"]:
+            del self.normalized_identifiers[source_name][form]
+        for source_name, basename in entry["identifier_basenames"]:
+            players = self.identifier_basenames[source_name][basename]
+            players.remove(player_id)
+            if len(players) == 0:
+                del self.identifier_basenames[source_name][basename]
+        for key in entry["mpris_matchers"]:
+            del self.mpris_matchers[key]
+
+    def validate_represents(self, player_ids: Iterable[str]) -> None:
+        """
+        Checks that the given players only represent players that exist
+        and, for players that do not exist, that no player represents them.
+        """
+        for player_id in player_ids:
+            if player_id not in self.players:
+                for other_id in self.represented_by.get(player_id, []):
+                    error(
+                        f'Player "{other_id}" represents non-existent player "{player_id}"'
+                    )
+                continue
+            for other_id in self.players[player_id]["represents"]:
+                if other_id not in self.players:
+                    error(
+                        f'Player "{player_id}" represents non-existent player "{other_id}"'
+                    )
+
+                # FIXME Allow nested "represents" relationships for now.
+                # These should not be allowed in theory, but nested relationships
+                # are needed for placeholders to be accepted. Music Presence
+                # currently does not read these recursively, so it's okay for now.
+                # They should never be read recursively.
+
+                # other = self.players[other_id]
+                # if len(other["represents"]) > 0:
+                #     error(
+                #         f'Player "{player_id}" cannot represent "{other_id}" '
+                #         f'because "{other_id}" already represents other players'
+                #     )
+
+
+def normalized_identifier(
+    source_name: str, identifier: str
+) -> tuple[list[str], list[str]]:
+    """
+    Returns the forms of a source identifier that clients compare against
+    the identifiers that media players report, as described in
+    api/specification.md, and the basenames of the forms that are paths,
+    which clients compare next to reported paths.
+    """
+    forms = [identifier]
+    basenames = []
+    if source_name == SourceName.WIN_SMTC.value:
+        # the text after a "!" is compared in title case, upper and lower case
+        head, separator, tail = identifier.partition("!")
+        if len(separator) > 0 and len(tail) > 0:
+            for variant in [tail.upper(), tail.lower()]:
+                if f"{head}!{variant}" not in forms:
+                    forms.append(f"{head}!{variant}")
+        for form in forms:
+            basename = form.rpartition("\\")[2]
+            if "\\" in form and len(basename) > 0 and basename not in basenames:
+                basenames.append(basename)
+    elif source_name == SourceName.LIN_MPRIS.value:
+        service = identifier.removeprefix(MPRIS_SERVICE_PREFIX)
+        for pattern in MPRIS_SUFFIX_PATTERNS:
+            match = pattern.search(service)
+            if match is not None:
+                service = service[: match.start(1)] + service[match.end(1) :]
+                break
+        forms = [service]
+    elif source_name == SourceName.WEB_DOMAIN.value:
+        forms = [identifier.removeprefix("www.")]
+    return forms, basenames
+
+
+def validate_cross_target_invariants(
+    targets: dict[str, ValidationTarget],
+) -> CrossTargetIndex:
+    index = CrossTargetIndex()
+    for player_id, target in targets.items():
+        index.add(player_id, target.content)
+    index.validate_represents(targets.keys())
+    return index
 
 
-def validate_targets(targets: dict[str, ValidationTarget]):
+def validate_targets(targets: dict[str, ValidationTarget]) -> CrossTargetIndex:
     for player_id, target in targets.items():
         assert player_id == target.id_from_filename
         validate_target(target)
-    validate_cross_target_invariants(targets)
+    return validate_cross_target_invariants(targets)
+
+
+def validate_changed_targets(root: str, paths: list[pathlib.Path]) -> int:
+    """
+    Validates only the players whose files changed since the last successful
+    validation and updates the cross-target index with them.
+    Returns the number of players that were validated.
+    """
+    files = {
+        pathlib.Path(path).relative_to(root).as_posix(): sha256sum(path)
+        for path in paths
+    }
+    manifest = read_manifest()
+    if manifest is None:
+        index = validate_targets(read_targets(root, paths))
+        write_manifest(files, index)
+        return len(paths)
+    previous_files: dict[str, str] = manifest["files"]
+    changed_paths = [
+        path
+        for path, file in zip(paths, files)
+        if previous_files.get(file) != files[file]
+    ]
+    removed_files = [file for file in previous_files if file not in files]
+    targets = read_targets(root, changed_paths)
+    for target in targets.values():
+        validate_target(target)
+    index = CrossTargetIndex(manifest["index"])
+    changed_ids = set()
+    for file in removed_files + [p.relative_to(root).as_posix() for p in changed_paths]:
+        player_id = pathlib.PurePosixPath(file).stem
+        if file in previous_files:
+            index.remove(player_id)
+        changed_ids.add(player_id)
+    for player_id, target in targets.items():
+        index.add(player_id, target.content)
+    index.validate_represents(sorted(changed_ids))
+    write_manifest(files, index)
+    return len(targets)
+
 
+def sha256sum(filename) -> str:
+    with open(filename, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
 
-def validate(root: str):
+
+def validation_digest() -> str:
+    # the manifest is only valid for the code and schemas that produced it
+    digest = hashlib.sha256()
+    filenames = [__file__, core.__file__]
+    filenames += sorted(pathlib.Path(core.SCHEMAS_DIR).rglob("*.json"))
+    for filename in filenames:
+        with open(filename, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def read_manifest() -> Optional[dict]:
+    if not os.path.exists(MANIFEST_FILE):
+        return None
+    try:
+        manifest = core.read_json(MANIFEST_FILE)
+    except core.ValidationError:
+        return None
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    if manifest.get("digest") != validation_digest():
+        return None
+    return manifest
+
+
+def write_manifest(files: dict[str, str], index: CrossTargetIndex) -> None:
+    # the manifest is only written after a successful validation,
+    # so invalid files are always validated again
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "digest": validation_digest(),
+        "files": files,
+        "index": index.state(),
+    }
+    pathlib.Path(MANIFEST_FILE).parent.mkdir(parents=True, exist_ok=True)
+    core.write_bytes_atomic(MANIFEST_FILE, json.dumps(manifest).encode("utf-8"))
+
+
+def validate(root: str, incremental: bool = False):
     log(f"Validating YAML definitions in {root}")
     with core.timed() as timer:
         try:
-            targets = get_targets(root)
-            validate_targets(targets)
+            paths = get_target_paths(root)
+            if incremental:
+                count = validate_changed_targets(root, paths)
+            else:
+                validate_targets(read_targets(root, paths))
+                count = len(paths)
         except core.ValidationError as e:
             print(f"ERROR {e}", file=sys.stderr)
             log(f"Took {timer.elapsed()}")
             exit(-1)
         elapsed = timer.elapsed()
-    log(f"Validated {len(targets)} players in {elapsed}")
+    log(f"Validated {count} of {len(paths)} players in {elapsed}")
 
 
 if __name__ == "__main__":
-    validate(PLAYERS_DIR)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--incremental", action="store_true")
+    args = parser.parse_args()
+    validate(PLAYERS_DIR, args.incremental)
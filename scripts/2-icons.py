@@ -8,62 +8,94 @@
 # - Directory /out/public/icons: Icons for players in subdirectories
 # - File /out/icons.json: A dictionary of objects that contains all generated
 #   icons and that satisfies the schema in src/schemas/icon.schema.json
+# - File /out/icon-sizes.json: The size of each icon in bytes,
+#   next to its size with the default encoding profile, per player and label
 #
-# Usage: 2-icons.py [player [player...]]
+# Usage: 2-icons.py [--no-cache] [--jobs N] [--by-hash]
+#                   [--memory-report] [--memory-budget B] [player [player...]]
 # - Generates icons for all players in the input directory,
 #   when no arguments are provided
 # - Generates icons for the specified players otherwise,
 #   but does not create the /out/icons.json output artifact
+# - Reuses previously generated icons from /.cache/icons,
+#   unless --no-cache is passed, and removes the least recently used ones
+#   from it, once it is larger than CACHE_MAX_SIZE
+# - Generates icons for multiple players in parallel with N processes,
+#   which defaults to the number of CPUs
+# - Stores each distinct icon once in /out/public/icons/by-hash,
+#   when --by-hash is passed, and points the URLs in icons.json there
+# - Reports the players and rules that need the most memory,
+#   when --memory-report is passed, and fails when generating an icon
+#   from a source image needs more than the budget of B megabytes,
+#   when --memory-budget B is passed, naming the image to downscale,
+#   in both cases with a single process
 #
 
+import argparse
+import concurrent.futures
+import contextlib
 import dataclasses
 import enum
+import filecmp
 import os
 import pathlib
 import sys
 import re
 import json
-import jsonschema
 import hashlib
 import shutil
+import tracemalloc
 from io import BytesIO
 from collections import defaultdict
 from typing import Optional
-from PIL import Image, ImageDraw
+import PIL
+from PIL import Image
 from dotenv import dotenv_values
-import warnings
 
 import core
 from core import log, warn, error, ValidationError
 
-# ignore jsonschema warnings for now
-warnings.filterwarnings("ignore", category=DeprecationWarning)
-
 DOTENV = dotenv_values(os.path.join(os.path.dirname(__file__), ".env"))
 GEN_BASE_URL_ICONS = f"{DOTENV["API_BASE_URL"]}/icons"
 
 ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
 OUT_DIR = os.path.join(ROOT_DIR, "out")
 OUT_ICONS_DIR = os.path.join(OUT_DIR, "public", "icons")
+OUT_BY_HASH_DIR = os.path.join(OUT_ICONS_DIR, "by-hash")
 OUT_EXCLUDED_ICONS_DIR = os.path.join(OUT_DIR, "excluded-icons")
 OUT_JSON_FILE = os.path.join(OUT_DIR, "icons.json")
+OUT_SIZES_FILE = os.path.join(OUT_DIR, "icon-sizes.json")
+CACHE_DIR = os.path.join(ROOT_DIR, ".cache", "icons")
+# the version of the code that renders and encodes icons in this file and
+# in core.py, which must be incremented whenever it changes generated icons
+GENERATOR_VERSION = 1
+# the least recently used icons are removed from the cache beyond this size,
+# which is a few times the size of all icons of a build
+CACHE_MAX_SIZE = 128 * 1024 * 1024
 IN_PLAYERS_DIR = os.path.join(ROOT_DIR, "src", "players")
 IN_ICONS_DIR = os.path.join(ROOT_DIR, "src", "icons")
-INTERNAL_SCHEMA_PATH = os.path.join(ROOT_DIR, "src", "schemas", "internal")
-GEN_SCHEMA = core.read_json(os.path.join(INTERNAL_SCHEMA_PATH, "gen.schema.json"))
-OVERRIDES_SCHEMA = core.read_json(
-    os.path.join(INTERNAL_SCHEMA_PATH, "gen-overrides.schema.json")
-)
+GEN_SCHEMA = "internal/gen.schema.json"
+OVERRIDES_SCHEMA = "internal/gen-overrides.schema.json"
 # only hash the tray menu logo for now, to not inflate the resulting JSON
 LABELS_TO_HASH = set(["tray-menu"])
 EXPORT_FORMAT = "PNG"
+# the largest size that is embedded in ICO files
+ICO_MAX_SIZE = 256
+# the largest width and height of WEBP images
+WEBP_MAX_SIZE = 16383
+# how much larger than the largest output size source images are kept,
+# so that each icon is still resampled from more pixels than it outputs
+WORKING_SIZE_OVERSAMPLING = 2
 SLUG_LENGTH = 12
+# how many of the players and rules that need the most memory are reported
+MEMORY_REPORT_SIZE = 10
 
 
 class ImageType(enum.Enum):
     PNG = "PNG"
     JPG = "JPG"
     ICO = "ICO"
+    WEBP = "WEBP"
 
     def __hash__(self):
         return [e.value for e in self.__class__].index(self.value)
@@ -77,6 +109,14 @@ class ImageShape(enum.Enum):
         return [e.value for e in self.__class__].index(self.value)
 
 
+class EncodingProfile(enum.Enum):
+    Default = "default"
+    Optimized = "optimized"
+
+    def __hash__(self):
+        return [e.value for e in self.__class__].index(self.value)
+
+
 class ColorCode(enum.Enum):
     Transparent = "transparent"
     Black = "black"
@@ -131,6 +171,14 @@ class GenerationRecipe:
     output_size: Optional[int] = None
     # whether to fail the build when there is no sufficiently large input image
     force_output_size: Optional[bool] = None
+    # how to encode the image, the optimized profile produces smaller files
+    encoding: EncodingProfile = EncodingProfile.Default
+    # the quality of lossy WEBP images from 0 to 100
+    # if not set, WEBP images are encoded losslessly
+    quality: Optional[int] = None
+    # the sizes that are embedded in ICO files, each rendered separately
+    # if not set, all sizes are scaled down from the largest possible image
+    ico_sizes: Optional[tuple[int, ...]] = None
 
     def slug(self) -> str:
         return hex(hash(self) % ((sys.maxsize + 1) * 2))[2:]
@@ -139,8 +187,26 @@ class GenerationRecipe:
         return self.image_scale * self.border_scale
 
     def validate(self) -> None:
+        self.validate_image_type()
+        if self.effective_image_scale() > 1.0:
+            raise ValidationError(
+                f"The effective image scale would scale up the image: "
+                f"{self.effective_image_scale()}"
+            )
+
+    def validate_image_type(self) -> None:
         if self.image_type == ImageType.ICO and self.output_size != None:
             raise ValidationError("Image type ICO cannot have an output size")
+        if self.ico_sizes is not None:
+            if self.image_type != ImageType.ICO:
+                raise ValidationError("ICO sizes are only supported for image type ICO")
+            if len(self.ico_sizes) == 0:
+                raise ValidationError("ICO sizes cannot be empty")
+            for size in self.ico_sizes:
+                if not 1 <= size <= ICO_MAX_SIZE:
+                    raise ValidationError(
+                        f"ICO sizes must be between 1 and {ICO_MAX_SIZE}: {size}"
+                    )
         if self.image_type == ImageType.JPG and self.output_shape != ImageShape.Square:
             raise ValidationError("Image type JPG cannot have a non-square shape")
         if self.image_type == ImageType.JPG and self.background_scale != 1.0:
@@ -148,11 +214,24 @@ class GenerationRecipe:
         bg = self.background.color(False)
         if self.image_type == ImageType.JPG and len(bg) == 8 and bg[-2:] != "ff":
             raise ValidationError("Image type JPG cannot have a transparent background")
-        if self.effective_image_scale() > 1.0:
+        if (
+            self.encoding == EncodingProfile.Optimized
+            and self.image_type != ImageType.PNG
+        ):
             raise ValidationError(
-                f"The effective image scale would scale up the image: "
-                f"{self.effective_image_scale()}"
+                "Optimized encoding is only supported for image type PNG"
             )
+        # WEBP supports transparency, so unlike JPG it allows any shape,
+        # background and background scale, lossy or lossless
+        if self.quality is not None and self.image_type != ImageType.WEBP:
+            raise ValidationError("Quality is only supported for image type WEBP")
+        if self.quality is not None and not 0 <= self.quality <= 100:
+            raise ValidationError(f"Quality must be between 0 and 100: {self.quality}")
+        if self.image_type == ImageType.WEBP and self.output_size is not None:
+            if self.output_size > WEBP_MAX_SIZE:
+                raise ValidationError(
+                    f"Image type WEBP cannot be larger than {WEBP_MAX_SIZE} pixels"
+                )
 
 
 @dataclasses.dataclass(frozen=True)
@@ -178,6 +257,9 @@ class GenerationRule(GenerationRecipe):
         background_scale = self.background_scale
         output_size = self.output_size
         force_output_size = self.force_output_size
+        encoding = self.encoding
+        quality = self.quality
+        ico_sizes = self.ico_sizes
         from_image = self.from_image
         label = self.label
         exclude = self.exclude
@@ -199,6 +281,12 @@ class GenerationRule(GenerationRecipe):
             output_size = values["output_size"]
         if "force_output_size" in values:
             force_output_size = values["force_output_size"]
+        if "encoding" in values:
+            encoding = EncodingProfile(values["encoding"])
+        if "quality" in values:
+            quality = values["quality"]
+        if "ico_sizes" in values:
+            ico_sizes = tuple(sorted(set(values["ico_sizes"]), reverse=True))
         if "from_image" in values:
             from_image = values["from_image"]
         if "label" in values:
@@ -215,6 +303,9 @@ class GenerationRule(GenerationRecipe):
             background_scale=background_scale,
             output_size=output_size,
             force_output_size=force_output_size,
+            encoding=encoding,
+            quality=quality,
+            ico_sizes=ico_sizes,
             label=label,
             from_image=from_image,
             exclude=exclude,
@@ -232,28 +323,415 @@ class IconResult:
     label: str
     image_type: ImageType
     image_path: str
+    md5: str
+    # the size of the file and the size it would have with default encoding
+    size: int
+    default_size: int
+
+
+class IconCache:
+    """
+    Persistent cache of generated icons, which outlives the output directory.
+    Entries are keyed by the source image, the resolved generation rule,
+    the generator version and the version of Pillow, so they never have to be
+    invalidated, and the least recently used ones are removed by prune().
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._source_digests: dict[tuple[str, int, int], str] = {}
+
+    def key(
+        self, rule: GenerationRule, image_path: str, working_size: Optional[int]
+    ) -> str:
+        fingerprint = {
+            "generator": GENERATOR_VERSION,
+            "pillow": PIL.__version__,
+            "source": self._source_digest(image_path),
+            "rule": rule_fingerprint(rule),
+            "working_size": working_size,
+        }
+        data = json.dumps(fingerprint, sort_keys=True).encode("utf-8")
+        return hashlib.sha256(data).hexdigest()
+
+    def restore(
+        self,
+        key: str,
+        rule: GenerationRule,
+        out_directory: str,
+        out_prefix: str,
+    ) -> Optional[IconResult]:
+        entry_path, meta_path = self._entry_paths(key, rule.image_type)
+        if not os.path.exists(meta_path):
+            return None
+        meta = core.read_json(meta_path)
+        # the modification time of the metadata marks when it was last used
+        os.utime(meta_path)
+        pathlib.Path(out_directory).mkdir(parents=True, exist_ok=True)
+        result_path = os.path.join(
+            out_directory, result_filename(out_prefix, meta["md5"], rule.image_type)
+        )
+        link_or_copy(entry_path, result_path)
+        export_unslugged(result_path, out_prefix, rule.image_type)
+        return IconResult(
+            label=rule.label,
+            image_type=rule.image_type,
+            image_path=result_path,
+            md5=meta["md5"],
+            size=meta["size"],
+            default_size=meta["default_size"],
+        )
+
+    def store(self, key: str, result: IconResult) -> None:
+        entry_path, meta_path = self._entry_paths(key, result.image_type)
+        pathlib.Path(entry_path).parent.mkdir(parents=True, exist_ok=True)
+        # the metadata is written last and marks the entry as complete
+        tmp_entry_path = f"{entry_path}.{os.getpid()}.tmp"
+        link_or_copy(result.image_path, tmp_entry_path)
+        os.replace(tmp_entry_path, entry_path)
+        meta = {
+            "md5": result.md5,
+            "size": result.size,
+            "default_size": result.default_size,
+        }
+        core.write_bytes_atomic(meta_path, json.dumps(meta).encode("utf-8"))
+
+    def prune(self, max_size: int = CACHE_MAX_SIZE) -> int:
+        """
+        Removes the least recently used entries, until the entries that
+        remain take up no more than the given size in bytes.
+        Returns the number of removed entries.
+        """
+        entries: dict[str, list[os.DirEntry]] = defaultdict(list)
+        for directory in pathlib.Path(self.directory).glob("??"):
+            for file in os.scandir(directory):
+                key, extension = os.path.splitext(file.name)
+                if extension != ".tmp":
+                    entries[os.path.join(directory, key)].append(file)
+        usages = []
+        total_size = 0
+        for base_path, files in entries.items():
+            meta = [file for file in files if file.name.endswith(".json")]
+            used = meta[0].stat().st_mtime if len(meta) > 0 else 0
+            size = sum(file.stat().st_size for file in files)
+            usages.append((used, size, base_path, files))
+            total_size += size
+        removed = 0
+        for _, size, base_path, files in sorted(usages, key=lambda usage: usage[0]):
+            if total_size <= max_size:
+                break
+            # the metadata is removed first and marks the entry as incomplete
+            for file in sorted(files, key=lambda file: not file.name.endswith(".json")):
+                os.remove(file.path)
+            total_size -= size
+            removed += 1
+        return removed
+
+    def _entry_paths(self, key: str, image_type: ImageType) -> tuple[str, str]:
+        base_path = os.path.join(self.directory, key[:2], key)
+        return f"{base_path}.{image_type.value.lower()}", f"{base_path}.json"
+
+    def _source_digest(self, image_path: str) -> str:
+        stat = os.stat(image_path)
+        stat_key = (image_path, stat.st_mtime_ns, stat.st_size)
+        if stat_key not in self._source_digests:
+            self._source_digests[stat_key] = sha256sum_files(image_path)
+        return self._source_digests[stat_key]
+
+
+class HashStore:
+    """
+    Content-addressed store of generated icons, in which icons that are
+    byte-identical across players and labels are stored as a single file.
+    Aliases of logos remain in the directory of their player.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.icon_count = 0
+        self.total_size = 0
+        self.saved_size = 0
+        self._paths: set[str] = set()
+
+    def add(self, result: IconResult) -> IconResult:
+        filename = f"{result.md5[:SLUG_LENGTH]}.{result.image_type.value.lower()}"
+        store_path = os.path.join(self.directory, filename)
+        self.icon_count += 1
+        self.total_size += result.size
+        if result.image_path == store_path:
+            # the icon was stored by a previous build
+            if store_path in self._paths:
+                self.saved_size += result.size
+            self._paths.add(store_path)
+            return result
+        if store_path in self._paths:
+            if not filecmp.cmp(store_path, result.image_path, shallow=False):
+                error(f"Icons with the same slug differ: {result.image_path}")
+            self.saved_size += result.size
+        else:
+            pathlib.Path(self.directory).mkdir(parents=True, exist_ok=True)
+            link_or_copy(result.image_path, store_path)
+            self._paths.add(store_path)
+        os.remove(result.image_path)
+        return dataclasses.replace(result, image_path=store_path)
+
+    def remove_unused(self) -> None:
+        """
+        Removes stored icons that were not added since the store was created.
+        """
+        for path in pathlib.Path(self.directory).glob("*"):
+            if str(path) not in self._paths:
+                os.remove(path)
+
+    def log_savings(self) -> None:
+        if self.total_size == 0:
+            return
+        log(
+            f"by-hash: {self.icon_count} icons in {len(self._paths)} files, "
+            f"saved {self.saved_size} bytes "
+            f"({100 * self.saved_size / self.total_size:.1f}%)"
+        )
+
+
+@dataclasses.dataclass
+class MemoryUsage:
+    player: str
+    label: str
+    image_path: str
+    source_size: tuple[int, int]
+    source_mode: str
+    # the largest size in pixels the icon needs from its source image,
+    # or None, if it needs the source image at its full resolution
+    required_size: Optional[int]
+    # the largest size in pixels of the icon, or None, if it has the size
+    # of the working image, and whether masks are drawn at that size
+    output_size: Optional[int]
+    masked: bool
+    # estimated size of the decoded source image, of the working image
+    # and of the masks while they are drawn
+    source_bytes: int
+    working_bytes: int
+    mask_bytes: int
+    # peak of Python allocations while generating the icon, zero when cached
+    python_bytes: int
+
+    def total(self) -> int:
+        return self.image_bytes() + self.python_bytes
+
+    def image_bytes(self) -> int:
+        # independent of the cache, unlike the Python allocations,
+        # so that the budget is checked the same way with and without it
+        return self.source_bytes + self.working_bytes + self.mask_bytes
+
+    def fitting_size(self, budget: int) -> int:
+        """
+        Returns the largest size in pixels of the longer side of the source
+        image, with which the images of this usage fit into the budget,
+        or zero, if they never fit.
+        """
+        low, high = 0, max(self.source_size)
+        while low < high:
+            side = (low + high + 1) // 2
+            needed = image_bytes(
+                self.source_size,
+                self.source_mode,
+                side,
+                self.required_size,
+                self.output_size,
+                self.masked,
+            )
+            if needed <= budget:
+                low = side
+            else:
+                high = side - 1
+        return low
+
+
+class MemoryReport:
+    """
+    Estimates the memory needed to generate each icon from the sizes of
+    the decoded images and of the masks, which are allocated by Pillow and
+    independent of the cache, and the peak of the Python allocations, traced
+    with tracemalloc. The budget is checked against the sizes of the images
+    and masks only, since the Python allocations are missing when an icon
+    is cached.
+    """
+
+    def __init__(self, budget: Optional[int] = None):
+        self.budget = budget
+        self.usages: list[MemoryUsage] = []
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def measure(
+        self,
+        player: str,
+        rule: GenerationRule,
+        image_path: str,
+        working_size: Optional[int],
+    ):
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+        yield
+        _, peak = tracemalloc.get_traced_memory()
+        with Image.open(image_path) as image:
+            size, mode = image.size, image.mode
+        working_side = max(size)
+        if working_size is not None:
+            working_side = min(working_side, working_size)
+        output_size = rule.output_size
+        if output_size is None and rule.ico_sizes is not None:
+            output_size = max(rule.ico_sizes)
+        masked = ImageShape.Circle in [rule.image_mask, rule.output_shape]
+        output_side = working_side
+        if output_size is not None:
+            output_side = min(output_side, output_size)
+        self.usages.append(
+            MemoryUsage(
+                player=player,
+                label=rule.label,
+                image_path=image_path,
+                source_size=size,
+                source_mode=mode,
+                required_size=working_size,
+                output_size=output_size,
+                masked=masked,
+                source_bytes=image_footprint(size, mode),
+                working_bytes=image_footprint((working_side, working_side), "RGBA"),
+                mask_bytes=core.mask_footprint(output_side) if masked else 0,
+                python_bytes=max(0, peak - start),
+            )
+        )
+
+    def over_budget(self) -> list[MemoryUsage]:
+        """
+        Returns the usage that needs the most memory of each source image
+        that needs more than the budget, if there is a budget.
+        """
+        if self.budget is None:
+            return []
+        usages: dict[str, MemoryUsage] = {}
+        for usage in self.usages:
+            if usage.image_bytes() <= self.budget:
+                continue
+            other = usages.get(usage.image_path)
+            if other is None or usage.image_bytes() > other.image_bytes():
+                usages[usage.image_path] = usage
+        return sorted(usages.values(), key=lambda usage: usage.image_path)
+
+    def log_report(self) -> None:
+        # the working images of a player are kept until all its icons are done
+        player_bytes: dict[str, int] = defaultdict(int)
+        working_bytes: dict[str, dict[str, int]] = defaultdict(dict)
+        for usage in self.usages:
+            working_bytes[usage.player][usage.image_path] = usage.working_bytes
+            player_bytes[usage.player] = max(
+                player_bytes[usage.player], usage.source_bytes + usage.python_bytes
+            )
+        for player, images in working_bytes.items():
+            player_bytes[player] += sum(images.values())
+        players = sorted(player_bytes.items(), key=lambda item: item[1], reverse=True)
+        log("Players that need the most memory:")
+        for player, size in players[:MEMORY_REPORT_SIZE]:
+            log(f"{format_megabytes(size):>10}  {player}")
+        usages = sorted(self.usages, key=lambda usage: usage.total(), reverse=True)
+        log("Rules that need the most memory:")
+        for usage in usages[:MEMORY_REPORT_SIZE]:
+            log(
+                f"{format_megabytes(usage.total()):>10}  "
+                f"{usage.player} {usage.label}: "
+                f"{format_megabytes(usage.source_bytes)} source, "
+                f"{format_megabytes(usage.working_bytes)} working image, "
+                f"{format_megabytes(usage.mask_bytes)} masks, "
+                f"{format_megabytes(usage.python_bytes)} Python"
+            )
+
+
+def image_footprint(size: tuple[int, int], mode: str) -> int:
+    # Pillow stores pixels with one byte for single band 8-bit images,
+    # two bytes for 16-bit images and four bytes for everything else
+    if mode in ["1", "L", "P"]:
+        pixel_size = 1
+    elif mode.startswith("I;16"):
+        pixel_size = 2
+    else:
+        pixel_size = 4
+    return size[0] * size[1] * pixel_size
+
+
+def image_bytes(
+    size: tuple[int, int],
+    mode: str,
+    side: int,
+    required_size: Optional[int],
+    output_size: Optional[int],
+    masked: bool,
+) -> int:
+    """
+    Returns the size of the decoded source image, of the working image
+    and of the masks, when the longer side of the source image
+    is downscaled to the given side.
+    """
+    scale = min(1, side / max(size))
+    scaled = (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+    working_side = max(scaled)
+    if required_size is not None:
+        working_side = min(working_side, required_size)
+    output_side = working_side
+    if output_size is not None:
+        output_side = min(output_side, output_size)
+    result = image_footprint(scaled, mode)
+    result += image_footprint((working_side, working_side), "RGBA")
+    if masked:
+        result += core.mask_footprint(output_side)
+    return result
+
+
+def format_megabytes(size: int) -> str:
+    return f"{size / 1024 / 1024:.1f}MB"
+
+
+def rule_fingerprint(rule: GenerationRule) -> dict[str, any]:
+    result = {}
+    for field in dataclasses.fields(rule):
+        value = getattr(rule, field.name)
+        if isinstance(value, enum.Enum):
+            value = value.value
+        elif isinstance(value, Color):
+            value = value.color()
+        result[field.name] = value
+    return result
+
+
+# generation rules by the path, modification time and size of their file,
+# since the rules of every player are read from the same file
+_generation_rules: dict[tuple[str, int, int], list[GenerationRule]] = {}
 
 
 def read_generation_rules(path: str):
-    content = core.read_yaml_with_schema(
-        path,
-        GEN_SCHEMA,
-        resolver=jsonschema.RefResolver(
-            base_uri=f"{pathlib.Path(INTERNAL_SCHEMA_PATH).as_uri()}/",
-            referrer=GEN_SCHEMA,
-        ),
-    )
-    raw_rules = content["rules"]
-    generation_rules: list[GenerationRule] = []
-    defaults = GenerationRule()
-    for rule in raw_rules:
-        res = defaults.update(rule)
-        res.validate()
-        generation_rules.append(res)
-    return generation_rules
+    stat = os.stat(path)
+    stat_key = (path, stat.st_mtime_ns, stat.st_size)
+    if stat_key not in _generation_rules:
+        content = core.read_yaml_with_schema(path, GEN_SCHEMA)
+        raw_rules = content["rules"]
+        generation_rules: list[GenerationRule] = []
+        defaults = GenerationRule()
+        for rule in raw_rules:
+            res = defaults.update(rule)
+            res.validate()
+            generation_rules.append(res)
+        _generation_rules[stat_key] = generation_rules
+    return list(_generation_rules[stat_key])
 
 
-def generate_player_icons(root: str, player: str) -> list[IconResult]:
+def read_player_rules(
+    root: str, player: str
+) -> tuple[list[GenerationRule], Optional[str]]:
+    """
+    Returns the generation rules of a player with its overrides applied
+    and the path of its base image, if it has one.
+    """
     gen_file = os.path.join(root, "gen.yaml")
     if not os.path.exists(gen_file):
         error(f"File does not exist: {gen_file}")
@@ -266,14 +744,7 @@ def generate_player_icons(root: str, player: str) -> list[IconResult]:
     generation_rules = read_generation_rules(gen_file)
     overrides_file = os.path.join(root, "overrides", f"{player}.yaml")
     if os.path.exists(overrides_file):
-        overrides = core.read_yaml_with_schema(
-            overrides_file,
-            OVERRIDES_SCHEMA,
-            jsonschema.RefResolver(
-                base_uri=f"{pathlib.Path(INTERNAL_SCHEMA_PATH).as_uri()}/",
-                referrer=OVERRIDES_SCHEMA,
-            ),
-        )
+        overrides = core.read_yaml_with_schema(overrides_file, OVERRIDES_SCHEMA)
         new_rules = []
         for rule in generation_rules:
             if "global" in overrides:
@@ -281,14 +752,58 @@ def generate_player_icons(root: str, player: str) -> list[IconResult]:
             if "label" in overrides:
                 if rule.label in overrides["label"]:
                     rule = rule.update(overrides["label"][rule.label])
+            # overrides may scale up the image, but must produce a valid image
+            rule.validate_image_type()
             new_rules.append(rule)
         generation_rules = new_rules
-    return generate_icons(
-        player=player,
-        rules=generation_rules,
-        base_image=base_image_file,
-        image_root=image_root,
-    )
+    return generation_rules, base_image_file
+
+
+def player_icon_inputs(root: str, player: str) -> list[str]:
+    """
+    Returns the paths of all files the icons of a player are generated from,
+    including files that do not exist, but would be used if they did.
+    """
+    image_root = os.path.join(root, "images")
+    inputs = [
+        os.path.join(root, "gen.yaml"),
+        os.path.join(root, "overrides", f"{player}.yaml"),
+        os.path.join(image_root, f"{player}.png"),
+        os.path.join(image_root, f"{player}.jpg"),
+    ]
+    rules, _ = read_player_rules(root, player)
+    for rule in rules:
+        if rule.from_image is not None:
+            inputs.append(os.path.join(image_root, rule.from_image))
+    return sorted(set(inputs))
+
+
+def generate_player_icons(
+    root: str,
+    player: str,
+    cache: Optional[IconCache] = None,
+    memory: Optional[MemoryReport] = None,
+) -> list[IconResult]:
+    with core.span(player, "player"):
+        generation_rules, base_image_file = read_player_rules(root, player)
+        return generate_icons(
+            player=player,
+            rules=generation_rules,
+            base_image=base_image_file,
+            image_root=os.path.join(root, "images"),
+            cache=cache,
+            memory=memory,
+        )
+
+
+def remove_player_icons(player: str) -> None:
+    """
+    Removes all icons that were generated for a player,
+    including the excluded icons, but not icons in the by-hash directory.
+    """
+    shutil.rmtree(os.path.join(OUT_ICONS_DIR, player), ignore_errors=True)
+    for path in pathlib.Path(OUT_EXCLUDED_ICONS_DIR).glob(f"*/{player}.*"):
+        os.remove(path)
 
 
 def generate_icons(
@@ -296,6 +811,8 @@ def generate_icons(
     rules: list[GenerationRule],
     base_image: Optional[str],
     image_root: str,
+    cache: Optional[IconCache] = None,
+    memory: Optional[MemoryReport] = None,
 ) -> list[IconResult]:
     if len(rules) == 0:
         error(f'Generation rules for player "{player}" are empty')
@@ -304,6 +821,7 @@ def generate_icons(
     labels: dict[str, int] = defaultdict(int)
     for rule in rules:
         labels[rule.label] += 1
+    rule_images: list[str] = []
     for i, rule in enumerate(rules):
         image_path = None
         if rule.from_image is not None:
@@ -318,40 +836,84 @@ def generate_icons(
         if base_image is None:
             warn(f"No image for rule {i} ({rule.label}) for player {player}")
             return []
-        rule_out_dir = out_dir
-        out_prefix = rule.label
-        if rule.exclude:
-            rule_out_dir = os.path.join(OUT_EXCLUDED_ICONS_DIR, rule.label)
-            out_prefix = player
-        image_path = generate_icon(
-            rule=rule,
-            image_path=image_path,
-            out_directory=rule_out_dir,
-            out_prefix=out_prefix,
-        )
-        if not rule.exclude:
-            results.append(
-                IconResult(
-                    label=rule.label,
-                    image_type=rule.image_type,
-                    image_path=image_path,
-                )
-            )
+        rule_images.append(image_path)
+    working_sizes = plan_working_sizes(rules, rule_images)
+    # decoded and squared images by path, shared by all rules of this player
+    # and released once the player is done to keep peak memory bounded
+    working_images: dict[str, Image.Image] = {}
+    for rule, image_path in zip(rules, rule_images):
+        with core.span(rule.label, "rule", player=player):
+            rule_out_dir = out_dir
+            out_prefix = rule.label
+            if rule.exclude:
+                rule_out_dir = os.path.join(OUT_EXCLUDED_ICONS_DIR, rule.label)
+                out_prefix = player
+            check_output_size(rule, image_path, source_size(image_path))
+            working_size = working_sizes[image_path]
+            measure = contextlib.nullcontext()
+            if memory is not None:
+                measure = memory.measure(player, rule, image_path, working_size)
+            with measure:
+                result = None
+                if cache is not None:
+                    cache_key = cache.key(rule, image_path, working_size)
+                    with core.span("cache", "step"):
+                        result = cache.restore(
+                            cache_key, rule, rule_out_dir, out_prefix
+                        )
+                if result is None:
+                    if image_path not in working_images:
+                        with core.span("decode", "step"):
+                            working_images[image_path] = open_working_image(
+                                image_path, working_size
+                            )
+                    result = generate_icon(
+                        rule=rule,
+                        image=working_images[image_path].copy(),
+                        out_directory=rule_out_dir,
+                        out_prefix=out_prefix,
+                    )
+                    if cache is not None:
+                        with core.span("cache", "step"):
+                            cache.store(cache_key, result)
+            if not rule.exclude:
+                results.append(result)
     # Export the Discord application logo variant of the image so that there
     # is a logo that can be uploaded to the Discord Developer portal
     return results
 
 
-def scale_image(image: Image.Image, factor: float):
-    if factor > 1.0:
-        raise ValueError("cannot upscale an image")
-    size = image.size[0]
-    new_size = int(size * factor)
-    image.thumbnail((new_size, new_size), Image.Resampling.LANCZOS)
-    paste_position = (new_size - size) // 2
-    result_image = Image.new(image.mode, (size, size), "#00000000")
-    result_image.paste(image, (-paste_position, -paste_position), image)
-    return result_image
+def required_size(rule: GenerationRule) -> Optional[int]:
+    """
+    Returns the largest size in pixels the rule needs from its source image
+    or None, if the rule needs the source image at its full resolution.
+    """
+    if rule.output_size is not None:
+        return rule.output_size * WORKING_SIZE_OVERSAMPLING
+    if rule.ico_sizes is not None:
+        return max(rule.ico_sizes) * WORKING_SIZE_OVERSAMPLING
+    if rule.image_type == ImageType.ICO:
+        return ICO_MAX_SIZE * WORKING_SIZE_OVERSAMPLING
+    return None
+
+
+def plan_working_sizes(
+    rules: list[GenerationRule], rule_images: list[str]
+) -> dict[str, Optional[int]]:
+    """
+    Determines the size each image can be reduced to before generating icons,
+    which is the largest size that any of the rules that use the image need.
+    """
+    result: dict[str, Optional[int]] = {}
+    for rule, image_path in zip(rules, rule_images):
+        size = required_size(rule)
+        if image_path not in result:
+            result[image_path] = size
+        elif size is None or result[image_path] is None:
+            result[image_path] = None
+        else:
+            result[image_path] = max(result[image_path], size)
+    return result
 
 
 def sha256sum_combined(*args, **kwargs) -> str:
@@ -363,14 +925,71 @@ def sha256sum_combined(*args, **kwargs) -> str:
     return result
 
 
-def generate_icon(
-    rule: GenerationRule,
-    image_path: str,
-    out_directory: str,
-    out_prefix: str = "",
-):
+def sha256sum_files(*filenames: str) -> str:
+    digest = hashlib.sha256()
+    for filename in filenames:
+        with open(filename, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def source_size(image_path: str) -> int:
+    # only reads the image header, the image data is not decoded
+    with Image.open(image_path) as image:
+        return max(image.size[0], image.size[1])
+
+
+def check_output_size(rule: GenerationRule, image_path: str, size: int) -> None:
+    if rule.output_size is None:
+        return
+    if rule.force_output_size and size < rule.output_size:
+        warn(
+            f"Rule {rule.label}: "
+            f"{pathlib.Path(image_path).name} has only "
+            f"{size} pixels, but "
+            f"{rule.output_size} are needed"
+        )
+
+
+def result_filename(out_prefix: str, md5: str, image_type: ImageType) -> str:
+    result_slug = md5[:SLUG_LENGTH]
+    return f"{out_prefix}.{result_slug}.{image_type.value.lower()}"
+
+
+def export_unslugged(result_path: str, out_prefix: str, image_type: ImageType):
+    if out_prefix.startswith("logo"):
+        result_file_noslug = f"{out_prefix}.{image_type.value.lower()}"
+        out_directory = os.path.dirname(result_path)
+        link_or_copy(result_path, os.path.join(out_directory, result_file_noslug))
+
+
+def link_or_copy(source: str, destination: str) -> None:
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def open_working_image(image_path: str, max_size: Optional[int] = None) -> Image.Image:
     # open the image
-    image = Image.open(image_path).convert("RGBA")
+    with Image.open(image_path) as source_image:
+        source_size = max(source_image.size[0], source_image.size[1])
+        if max_size is None or source_size <= max_size:
+            image = source_image.convert("RGBA")
+        else:
+            # reduce the image to the largest size that is needed,
+            # with a fast integer reduction followed by a single resample
+            factor = max_size / source_size
+            size = (
+                max(1, round(source_image.size[0] * factor)),
+                max(1, round(source_image.size[1] * factor)),
+            )
+            source_image.draft("RGB", size)
+            image = source_image.convert("RGBA").resize(
+                size, Image.Resampling.LANCZOS, reducing_gap=3.0
+            )
     # center-paste the image on a transparent background if it's not a square
     if image.size[0] != image.size[1]:
         max_size = max(image.size[0], image.size[1])
@@ -378,91 +997,236 @@ def generate_icon(
         diff = (max_size - image.size[0], max_size - image.size[1])
         base_image.paste(image, (diff[0] // 2, diff[1] // 2), image)
         image = base_image
-    image_size = image.size[0]
-    # mask the image
-    if rule.image_mask == ImageShape.Square:
-        pass  # nothing to do
-    elif rule.image_mask == ImageShape.Circle:
-        image_mask = Image.new("L", image.size, 0)
-        image_draw = ImageDraw.Draw(image_mask)
-        image_draw.ellipse((0, 0) + (image_size - 0, image_size - 0), fill=255)
-        image = core.apply_mask(image, image_mask)
-    # scale the image
-    effective_image_scale = rule.image_scale * rule.border_scale
+    return image
+
+
+def render_icon(rule: GenerationRule, image: Image.Image) -> Image.Image:
+    """
+    Renders an icon from a square RGBA image, as returned by open_working_image().
+    The image is resampled once, directly to its size in the output,
+    and the masks and the background are drawn at the output size.
+    """
+    assert image.mode == "RGBA" and image.size[0] == image.size[1]
+    # determine the output size, images are never scaled up
+    output_size = image.size[0]
+    if rule.output_size is not None:
+        output_size = min(output_size, rule.output_size)
+    # determine the scale of the image and the background
+    effective_image_scale = rule.effective_image_scale()
     background_scale = rule.background_scale
     if effective_image_scale > 1.0:
         # Scale the background down when the image would be upscaled.
         down_factor = effective_image_scale
         background_scale /= down_factor
         effective_image_scale = 1.0
-    image = scale_image(image, effective_image_scale)
+    # scale the image and mask it
+    scaled_size = max(1, round(output_size * effective_image_scale))
+    with core.span("resample", "step"):
+        scaled_image = image.resize(
+            (scaled_size, scaled_size), Image.Resampling.LANCZOS, reducing_gap=3.0
+        )
+    if rule.image_mask == ImageShape.Square:
+        pass  # nothing to do
+    elif rule.image_mask == ImageShape.Circle:
+        scaled_image = core.apply_mask(scaled_image, core.circle_mask(scaled_size))
+    result_image = Image.new("RGBA", (output_size, output_size), "#00000000")
+    position = (output_size - scaled_size + 1) // 2
+    result_image.paste(scaled_image, (position, position), scaled_image)
     # create the background
-    background_image = Image.new("RGBA", image.size, rule.background.color())
+    background_size = max(1, round(output_size * background_scale))
+    background = Image.new(
+        "RGBA", (background_size, background_size), rule.background.color()
+    )
     # mask the result images
     if rule.output_shape == ImageShape.Square:
         pass  # nothing to do
     elif rule.output_shape == ImageShape.Circle:
-        image_mask = Image.new("L", image.size, 0)
-        image_draw = ImageDraw.Draw(image_mask)
-        image_draw.ellipse((0, 0) + (image_size - 0, image_size - 0), fill=255)
-        image = core.apply_mask(image, image_mask)
-        background_mask = Image.new("L", image.size, 0)
-        background_draw = ImageDraw.Draw(background_mask)
-        background_draw.ellipse((0, 0) + (image_size - 0, image_size - 0), fill=255)
-        background_image = core.apply_mask(background_image, background_mask)
-    # scale the background
-    background_image = scale_image(background_image, background_scale)
-    background_image_format = EXPORT_FORMAT
+        result_image = core.apply_mask(result_image, core.circle_mask(output_size))
+        background = core.apply_mask(background, core.circle_mask(background_size))
+    background_image = Image.new("RGBA", (output_size, output_size), "#00000000")
+    position = (output_size - background_size + 1) // 2
+    background_image.paste(background, (position, position), background)
     # put the image on top of the background
-    assert background_image.size == image.size
-    background_image = Image.alpha_composite(background_image, image)
-    # resize the image to the output size
-    if rule.output_size is not None:
-        assert background_image.size[0] == background_image.size[1]
-        if rule.force_output_size and background_image.size[0] < rule.output_size:
-            warn(
-                f"Rule {rule.label}: "
-                f"{pathlib.Path(image_path).name} has only "
-                f"{background_image.size[0]} pixels, but "
-                f"{rule.output_size} are needed"
-            )
-        output_size = (rule.output_size, rule.output_size)
-        background_image.thumbnail(output_size, Image.Resampling.LANCZOS)
-        image_size = output_size[0]
-    # determine the result file and location
-    pathlib.Path(out_directory).mkdir(parents=True, exist_ok=True)
-    tmp_result_file = f"tmp.{rule.image_type.value.lower()}"
-    tmp_result_path = os.path.join(out_directory, tmp_result_file)
+    return Image.alpha_composite(background_image, result_image)
+
+
+def render_ico_images(rule: GenerationRule, image: Image.Image) -> list[Image.Image]:
+    """
+    Renders each of the sizes of an ICO rule from the same working image,
+    largest first, so every size is resampled once and has its own mask.
+    Sizes larger than the image are skipped, as images are never scaled up.
+    """
+    if rule.ico_sizes is None:
+        return []
+    sizes = [size for size in rule.ico_sizes if size <= image.size[0]]
+    if len(sizes) == 0:
+        error(
+            f"Image of {image.size[0]} pixels is smaller than all ICO sizes "
+            f"of rule {rule.label}: {', '.join(map(str, rule.ico_sizes))}"
+        )
+    result = []
+    for size in sorted(sizes, reverse=True):
+        # the rule only specifies an output size for rendering
+        size_rule = dataclasses.replace(rule, output_size=size)
+        result.append(render_icon(size_rule, image))
+    return result
+
+
+def check_ico_sizes(rule: GenerationRule, data: bytes) -> None:
+    # the encoder might add sizes, which would make them unpredictable
+    with Image.open(BytesIO(data)) as image:
+        sizes = sorted(set(size[0] for size in image.info["sizes"]))
+    unlisted = [size for size in sizes if size not in rule.ico_sizes]
+    if len(unlisted) > 0:
+        error(
+            f"ICO of rule {rule.label} contains sizes that are not listed: "
+            f"{', '.join(map(str, unlisted))}"
+        )
+
+
+def encode_icon(
+    rule: GenerationRule,
+    image: Image.Image,
+    encoding: Optional[EncodingProfile] = None,
+    append_images: Optional[list[Image.Image]] = None,
+) -> bytes:
+    """
+    Encodes an icon in the image type of the rule. ICO files embed the
+    additional images at their own sizes, all other types ignore them.
+    """
+    if encoding is None:
+        encoding = rule.encoding
+    if append_images is None:
+        append_images = []
+    with BytesIO() as byte_io:
+        # save the image based on result image type
+        if rule.image_type == ImageType.PNG:
+            if encoding == EncodingProfile.Optimized:
+                palette_image = reduce_to_palette(image)
+                if palette_image is not None:
+                    image = palette_image
+                image.save(byte_io, EXPORT_FORMAT, optimize=True)
+            else:
+                image.save(byte_io, EXPORT_FORMAT)
+        elif rule.image_type == ImageType.JPG:
+            # use a prominent color so it's obvious when transparency is removed
+            base_image = Image.new("RGB", image.size, "#f0f")
+            base_image.paste(image, (0, 0), image)
+            base_image.save(byte_io, "JPEG")
+        elif rule.image_type == ImageType.ICO:
+            if rule.ico_sizes is not None:
+                sizes = [image.size] + [e.size for e in append_images]
+                image.save(byte_io, "ICO", sizes=sizes, append_images=append_images)
+            else:
+                image.save(byte_io, "ICO")
+        elif rule.image_type == ImageType.WEBP:
+            # quality is the compression effort for lossless images
+            if rule.quality is None:
+                image.save(byte_io, "WEBP", lossless=True, quality=100, method=6)
+            else:
+                image.save(byte_io, "WEBP", quality=rule.quality, method=6)
+        else:
+            error(f"Unrecognized result image type: {rule.image_type}")
+        return byte_io.getvalue()
+
+
+def reduce_to_palette(image: Image.Image) -> Optional[Image.Image]:
+    """
+    Converts an RGBA image with at most 256 colors to a palette image
+    without losing any information, returns None if there are more colors.
+    """
+    colors = image.getcolors(256)
+    if colors is None:
+        return None
+    # sort the colors so that the palette does not depend on pixel order
+    palette = sorted(color for _, color in colors)
+    indices = {
+        int.from_bytes(bytes(color), sys.byteorder): i
+        for i, color in enumerate(palette)
+    }
+    pixels = memoryview(image.tobytes()).cast("I")
+    result = Image.frombytes("P", image.size, bytes(map(indices.__getitem__, pixels)))
+    result.putpalette(b"".join(bytes(color) for color in palette), "RGBA")
+    return result
+
+
+def write_icon(
+    rule: GenerationRule,
+    data: bytes,
+    out_directory: str,
+    out_prefix: str = "",
+    default_size: Optional[int] = None,
+) -> IconResult:
+    # the digest is both the slug of the file name and the published md5
+    with core.span("hash", "step"):
+        result_md5 = hashlib.md5(data).hexdigest()
+    result_file = result_filename(out_prefix, result_md5, rule.image_type)
+    result_path = os.path.join(out_directory, result_file)
 
     # FIXME
     # if os.path.exists(result_path):
     #     error(f"Output image already exists, duplicate rule? {result_path}")
 
-    # save the image based on result image type
-    if rule.image_type == ImageType.PNG:
-        background_image.save(tmp_result_path, background_image_format)
-    elif rule.image_type == ImageType.JPG:
-        # use a prominent color so it's obvious when transparency is removed
-        base_image = Image.new("RGB", background_image.size, "#f0f")
-        base_image.paste(background_image, (0, 0), background_image)
-        base_image.save(tmp_result_path, "JPEG")
-    elif rule.image_type == ImageType.ICO:
-        background_image.save(tmp_result_path, "ICO")
-    else:
-        error(f"Unrecognized result image type: {rule.image_type}")
-    result_slug = md5sum(tmp_result_path)[:SLUG_LENGTH]
-    result_file = f"{out_prefix}.{result_slug}.{rule.image_type.value.lower()}"
-    result_path = os.path.join(out_directory, result_file)
-    os.rename(tmp_result_path, result_path)
-    if out_prefix.startswith("logo"):
-        result_file_noslug = f"{out_prefix}.{rule.image_type.value.lower()}"
-        shutil.copy2(result_path, os.path.join(out_directory, result_file_noslug))
-    return result_path
+    with core.span("write", "step"):
+        pathlib.Path(out_directory).mkdir(parents=True, exist_ok=True)
+        core.write_bytes_atomic(result_path, data)
+        export_unslugged(result_path, out_prefix, rule.image_type)
+    return IconResult(
+        label=rule.label,
+        image_type=rule.image_type,
+        image_path=result_path,
+        md5=result_md5,
+        size=len(data),
+        default_size=len(data) if default_size is None else default_size,
+    )
 
 
-def md5sum(filename: str) -> str:
-    with open(filename, "rb") as f:
-        return hashlib.md5(f.read()).hexdigest()
+def generate_icon(
+    rule: GenerationRule,
+    image: Image.Image,
+    out_directory: str,
+    out_prefix: str = "",
+) -> IconResult:
+    images = render_ico_images(rule, image)
+    if len(images) == 0:
+        images = [render_icon(rule, image)]
+    result_image, append_images = images[0], images[1:]
+    with core.span("encode", "step"):
+        data = encode_icon(rule, result_image, append_images=append_images)
+    if rule.ico_sizes is not None:
+        check_ico_sizes(rule, data)
+    default_size = None
+    if rule.encoding != EncodingProfile.Default:
+        # only needed for the report of how many bytes the encoding saved
+        with core.span("encode-default", "step"):
+            default_data = encode_icon(
+                rule, result_image, EncodingProfile.Default, append_images
+            )
+        default_size = len(default_data)
+    return write_icon(rule, data, out_directory, out_prefix, default_size)
+
+
+def write_size_report(results: dict[str, list[IconResult]]) -> None:
+    report = {"labels": {}, "icons": {}}
+    for player, player_results in results.items():
+        report["icons"][player] = {}
+        for result in player_results:
+            sizes = {"size": result.size, "default_size": result.default_size}
+            report["icons"][player][result.label] = sizes
+            label_sizes = report["labels"].setdefault(
+                result.label, {"size": 0, "default_size": 0}
+            )
+            label_sizes["size"] += result.size
+            label_sizes["default_size"] += result.default_size
+    for label, sizes in report["labels"].items():
+        if sizes["size"] != sizes["default_size"]:
+            saved = sizes["default_size"] - sizes["size"]
+            log(
+                f"{label}: {sizes['size']} bytes, saved {saved} bytes "
+                f"({100 * saved / sizes['default_size']:.1f}%)"
+            )
+    with open(OUT_SIZES_FILE, "wt") as f:
+        f.write(json.dumps(report, indent=2))
 
 
 def md5sum_image(image: Image.Image, format: str) -> str:
@@ -472,47 +1236,163 @@ def md5sum_image(image: Image.Image, format: str) -> str:
     return hashlib.md5(data).hexdigest()
 
 
-if __name__ == "__main__":
-    output_json = True
-    if len(sys.argv) > 1:
-        players = sys.argv[1:]
-        output_json = False
-    else:
-        files = list(pathlib.Path(IN_PLAYERS_DIR).rglob("*.yaml"))
-        duplicate_files = core.duplicates(files, window=lambda f: f.stem)
-        if len(duplicate_files) > 0:
-            out = "".join([f.name for f in duplicate_files])
-            log(f"ERROR Duplicate players: {out}")
-            exit(-1)
-        players = sorted(f.stem for f in files)
+def find_players() -> list[str]:
+    files = list(pathlib.Path(IN_PLAYERS_DIR).rglob("*.yaml"))
+    duplicate_files = core.duplicates(files, window=lambda f: f.stem)
+    if len(duplicate_files) > 0:
+        out = "".join([f.name for f in duplicate_files])
+        log(f"ERROR Duplicate players: {out}")
+        exit(-1)
+    return sorted(f.stem for f in files)
 
-    output = {}
+
+def generate_all_icons(
+    players: Optional[list[str]] = None,
+    cache: Optional[IconCache] = None,
+    jobs: int = 1,
+    hash_store: Optional[HashStore] = None,
+    previous: Optional[dict[str, list[IconResult]]] = None,
+    memory: Optional[MemoryReport] = None,
+) -> dict[str, list[IconResult]]:
+    """
+    Generates the icons for the given players, or for all players,
+    and returns the results of each player. Players with previous results
+    are not generated again, their results are used as they are instead.
+    The icons.json and icon-sizes.json artifacts are only written
+    when icons are generated for all players.
+    Memory is measured within this process, so there are no worker processes
+    when there is a memory report.
+    """
+    output_json = players is None
+    if players is None:
+        players = find_players()
+    if previous is None:
+        previous = {}
+    if hash_store is not None and os.path.basename(OUT_BY_HASH_DIR) in players:
+        log("ERROR Player conflicts with the by-hash directory")
+        exit(-1)
+    # icons of earlier runs would remain next to the new ones otherwise
     for player in players:
-        log(player)
-        try:
-            results = generate_player_icons(IN_ICONS_DIR, player)
-        except ValidationError as e:
-            log(f"ERROR {player}: {e}")
-            exit(-1)
-        if len(results) > 0:
-            objects = []
-            for result in results:
-                path = str(
-                    pathlib.PurePosixPath(
-                        pathlib.Path(result.image_path).relative_to(OUT_ICONS_DIR)
-                    )
-                )
-                assert path == f"{player}/{pathlib.Path(result.image_path).name}"
-                o = {
-                    "label": result.label,
-                    "type": result.image_type.value.lower(),
-                    "url": f"{GEN_BASE_URL_ICONS}/{path}",
-                }
-                if result.label in LABELS_TO_HASH:
-                    o["md5"] = md5sum(result.image_path)
-                objects.append(o)
-            output[player] = objects
+        if player not in previous:
+            remove_player_icons(player)
+
+    # players are submitted to the pool in order and their results
+    # are collected in the same order, so the output stays deterministic
+    executor = None
+    futures: dict[str, concurrent.futures.Future] = {}
+    generated_players = [player for player in players if player not in previous]
+    if jobs > 1 and len(generated_players) > 1 and memory is None:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+        for player in generated_players:
+            futures[player] = executor.submit(
+                core.call_traced, generate_player_icons, IN_ICONS_DIR, player, cache
+            )
+
+    player_results: dict[str, list[IconResult]] = {}
+    for player in players:
+        if player in previous:
+            results = previous[player]
+        else:
+            log(player)
+            try:
+                if executor is not None:
+                    results, events = futures[player].result()
+                    core.merge_trace(events)
+                else:
+                    results = generate_player_icons(IN_ICONS_DIR, player, cache, memory)
+            except ValidationError as e:
+                log(f"ERROR {player}: {e}")
+                if executor is not None:
+                    executor.shutdown(cancel_futures=True)
+                exit(-1)
+        if hash_store is not None:
+            results = [hash_store.add(result) for result in results]
+        player_results[player] = results
+    if executor is not None:
+        executor.shutdown()
     if output_json:
-        json_output = json.dumps(output, separators=(",", ":"))
+        json_output = json.dumps(icon_objects(player_results), separators=(",", ":"))
         with open(OUT_JSON_FILE, "wt") as f:
             f.write(json_output)
+        write_size_report(player_results)
+        if hash_store is not None:
+            hash_store.remove_unused()
+        elif os.path.basename(OUT_BY_HASH_DIR) not in players:
+            shutil.rmtree(OUT_BY_HASH_DIR, ignore_errors=True)
+    if hash_store is not None:
+        hash_store.log_savings()
+    if cache is not None:
+        removed = cache.prune()
+        if removed > 0:
+            log(f"Removed {removed} least recently used icons from the cache")
+    if memory is not None:
+        memory.log_report()
+        over_budget = memory.over_budget()
+        for usage in over_budget:
+            side = usage.fitting_size(memory.budget)
+            advice = (
+                f"downscale it to {side} pixels or less"
+                if side > 0
+                else "the budget is too small for any size"
+            )
+            log(
+                f"ERROR {usage.player} {usage.label}: "
+                f"{pathlib.Path(usage.image_path).name} needs "
+                f"{format_megabytes(usage.image_bytes())}, "
+                f"more than the budget of {format_megabytes(memory.budget)}, "
+                f"{advice}"
+            )
+        if len(over_budget) > 0:
+            exit(-1)
+    return player_results
+
+
+def icon_objects(
+    player_results: dict[str, list[IconResult]],
+) -> dict[str, list[dict]]:
+    """
+    Returns the icon objects of each player, as they appear in icons.json.
+    """
+    output = {}
+    for player, results in player_results.items():
+        if len(results) == 0:
+            continue
+        objects = []
+        for result in results:
+            directory, filename = os.path.split(result.image_path)
+            path = f"{os.path.basename(directory)}/{filename}"
+            assert directory in [os.path.join(OUT_ICONS_DIR, player), OUT_BY_HASH_DIR]
+            o = {
+                "label": result.label,
+                "type": result.image_type.value.lower(),
+                "url": f"{GEN_BASE_URL_ICONS}/{path}",
+            }
+            if result.label in LABELS_TO_HASH:
+                o["md5"] = result.md5
+            objects.append(o)
+        output[player] = objects
+    return output
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("players", nargs="*")
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--by-hash", action="store_true")
+    parser.add_argument("--memory-report", action="store_true")
+    parser.add_argument("--memory-budget", type=float, metavar="MEGABYTES")
+    args = parser.parse_args()
+    memory = None
+    if args.memory_report or args.memory_budget is not None:
+        budget = None
+        if args.memory_budget is not None:
+            budget = round(args.memory_budget * 1024 * 1024)
+        memory = MemoryReport(budget)
+    generate_all_icons(
+        players=args.players if len(args.players) > 0 else None,
+        cache=None if args.no_cache else IconCache(CACHE_DIR),
+        jobs=args.jobs,
+        hash_store=HashStore(OUT_BY_HASH_DIR) if args.by_hash else None,
+        memory=memory,
+    )
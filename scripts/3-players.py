@@ -11,20 +11,17 @@
 
 import os
 import sys
+import copy
 import json
 import jsonschema
 import pathlib
 from typing import Optional
 from dotenv import dotenv_values
-import warnings
 
 import core
 from core import log, warn, error
 from _version import VERSION
 
-# ignore jsonschema warnings for now
-warnings.filterwarnings("ignore", category=DeprecationWarning)
-
 DOTENV = dotenv_values(os.path.join(os.path.dirname(__file__), ".env"))
 API_VERSION = int(DOTENV["API_VERSION"])
 API_BASE_URL = DOTENV["API_BASE_URL"]
@@ -38,8 +35,11 @@ OUT_PLAYERS_DIRECTORY = os.path.join(OUT_DIR, "public")
 OUT_PLAYERS_BASENAME = "players"
 OUT_PLAYERS_MIN_SUFFIX = "min"
 OUT_PLAYERS_EXTENSION = "json"
-SCHEMA_PATH = os.path.join(SRC_DIR, "schemas")
-PLAYERS_SCHEMA = core.read_json(os.path.join(SCHEMA_PATH, "players.schema.json"))
+PLAYERS_SCHEMA = "players.schema.json"
+PLAYER_SCHEMA = "players.schema.json#/definitions/player"
+PLAYER_ICONS_SCHEMA = "players.schema.json#/properties/icons"
+# the properties of a player that differ between subsets
+SUBSET_PROPERTIES = ["sources", "experimental"]
 
 
 class Subset:
@@ -69,14 +69,29 @@ for subset in SUBSET_PLATFORM_PREFIXES:
 
 
 def validate_players(object: dict):
-    jsonschema.validate(
-        object,
-        PLAYERS_SCHEMA,
-        resolver=jsonschema.RefResolver(
-            base_uri=f"{pathlib.Path(SCHEMA_PATH).as_uri()}/",
-            referrer=PLAYERS_SCHEMA,
-        ),
-    )
+    # players and icons are validated as they are added,
+    # the first player is kept, since there must be at least one
+    envelope = {**object, "players": object["players"][:1], "icons": {}}
+    core.validate_with_schema(envelope, PLAYERS_SCHEMA)
+
+
+def validate_player(player: str, instance: any, schema: str):
+    try:
+        core.validate_with_schema(instance, schema)
+    except jsonschema.ValidationError as e:
+        error(f'Schema validation error:\n\nPlayer "{player}":\n\n{e}')
+
+
+def validate_projection(player: str, projection: dict, full: dict):
+    """
+    Validates the properties of a subset projection of a player
+    that differ from its full projection, which was validated already.
+    """
+    for key in SUBSET_PROPERTIES:
+        if key in projection and projection[key] != full.get(key):
+            validate_player(
+                player, projection[key], f"player.schema.json#/properties/{key}"
+            )
 
 
 def fix_schema_reference(object: dict):
@@ -131,12 +146,7 @@ def fix_move_source_matcher_dicts(content: dict[str, any]):
         lin_mpris_identity.extend(moved)
 
 
-def generate(root: str, subset: Optional[Subset] = None):
-    output_filename = get_output_file(subset, False)
-    log(f"Compiling {pathlib.Path(output_filename).name}")
-    icons = core.read_json(GENERATED_ICONS_FILE)
-    paths = pathlib.Path(root).rglob("*.yaml")
-    paths = sorted(paths, key=lambda p: p.stem)
+def new_players_document(subset: Optional[Subset] = None) -> dict:
     result = {
         "$schema": f"players.schema.json",
         "version": VERSION,
@@ -147,27 +157,34 @@ def generate(root: str, subset: Optional[Subset] = None):
     }
     if subset is None:
         del result["subset"]
-    total = 0
-    for path in paths:
-        content = core.read_yaml(path)
-        assert "id" in content
-        player = content["id"]
-        if subset is not None:
-            source_names = set(content["sources"].keys())
-            to_include = subset.filter(source_names)
-            if len(to_include) == 0:
-                continue  # nothing to include, skip
-            for source_name in source_names - to_include:
-                del content["sources"][source_name]
-        fix_platform_identifiers(content["sources"])
-        fix_move_source_matcher_dicts(content)
-        result["players"].append(content)
-        total += 1
-        if player not in icons:
-            log(f"WARN No icons for {player}")
-            continue
-        result["icons"][player] = icons[player]
-    log(f"Compiled {total} players")
+    return result
+
+
+def project_player(content: dict, subset: Optional[Subset] = None) -> Optional[dict]:
+    """
+    Returns a copy of a player with only the sources of the subset
+    and with the fixes for this version applied,
+    or None, if none of its sources are in the subset.
+    """
+    source_names = set(content["sources"].keys())
+    to_include = source_names
+    if subset is not None:
+        to_include = subset.filter(source_names)
+        if len(to_include) == 0:
+            return None
+    # the fixes modify the player, which is shared by all subsets
+    result = copy.deepcopy(content)
+    for source_name in source_names - to_include:
+        del result["sources"][source_name]
+    fix_platform_identifiers(result["sources"])
+    fix_move_source_matcher_dicts(result)
+    return result
+
+
+def write_players(result: dict, subset: Optional[Subset] = None):
+    output_filename = get_output_file(subset, False)
+    name = pathlib.Path(output_filename).name
+    log(f"Compiled {len(result['players'])} players into {name}")
     # validate the result
     validate_players(result)
     # fix the schema reference
@@ -179,7 +196,46 @@ def generate(root: str, subset: Optional[Subset] = None):
         f.write(json.dumps(result, separators=(",", ":")))
 
 
+def generate(root: str, icons: Optional[dict[str, list[dict]]] = None):
+    """
+    Compiles the players file and the file of each subset in a single pass,
+    in which each player definition is parsed once and projected into
+    every subset.
+    """
+    # icons are read from /out/icons.json, unless they are passed directly
+    if icons is None:
+        icons = core.read_json(GENERATED_ICONS_FILE)
+    subsets = [None, *SUBSET_PLATFORM_PREFIXES]
+    results = [new_players_document(subset) for subset in subsets]
+    paths = pathlib.Path(root).rglob("*.yaml")
+    paths = sorted(paths, key=lambda p: p.stem)
+    seen = set()
+    for content in core.read_yaml_corpus(paths):
+        assert "id" in content
+        player = content["id"]
+        # instead of the uniqueness check of the whole players list
+        if player in seen:
+            error(f'Duplicate player "{player}"')
+        seen.add(player)
+        if player not in icons:
+            log(f"WARN No icons for {player}")
+        else:
+            validate_player(player, {player: icons[player]}, PLAYER_ICONS_SCHEMA)
+        full = project_player(content)
+        validate_player(player, full, PLAYER_SCHEMA)
+        for subset, result in zip(subsets, results):
+            projection = full if subset is None else project_player(content, subset)
+            if projection is None:
+                continue  # nothing to include, skip
+            if projection is not full:
+                validate_projection(player, projection, full)
+            result["players"].append(projection)
+            if player in icons:
+                result["icons"][player] = icons[player]
+    for subset, result in zip(subsets, results):
+        with core.span(subset.name if subset is not None else "all", "subset"):
+            write_players(result, subset)
+
+
 if __name__ == "__main__":
     generate(PLAYERS_DIR)
-    for subset in SUBSET_PLATFORM_PREFIXES:
-        generate(PLAYERS_DIR, subset=subset)
@@ -30,15 +30,21 @@ OUT_PUBLIC_DIR = os.path.join(ROOT_DIR, "out", "public")
 OUT_STATIC_DIR = os.path.join(OUT_PUBLIC_DIR, "static")
 OUT_SCHEMAS_DIR = os.path.join(OUT_PUBLIC_DIR, "schemas")
 SRC_SCHEMAS_DIR = os.path.join(SRC_DIR, "schemas")
+STATIC_FILE = os.path.join(SRC_DIR, "static.yaml")
+
+
+def static_source_path(file: dict) -> str:
+    # source paths are absolute paths, relative to the repository root
+    abs_source_path = pathlib.Path(file["from"])
+    return os.path.join(ROOT_DIR, abs_source_path.relative_to("/"))
 
 
 def copy_static():
     pathlib.Path(OUT_STATIC_DIR).mkdir(parents=True, exist_ok=True)
-    static_files = core.read_yaml(os.path.join(SRC_DIR, "static.yaml"))
+    static_files = core.read_yaml(STATIC_FILE)
     for file in static_files:
         result_name = file["name"]
-        abs_source_path = pathlib.Path(file["from"])
-        source_path = os.path.join(ROOT_DIR, abs_source_path.relative_to("/"))
+        source_path = static_source_path(file)
         if not os.path.exists(source_path):
             error(f"source path does not exist: {source_path}")
         if not "sizes" in file:
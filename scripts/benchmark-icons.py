@@ -0,0 +1,388 @@
+#
+# benchmark-icons.py
+# Measures the speed and memory usage of the icon pipeline in 2-icons.py
+#
+# Input: - (source images are synthesized)
+# Output: -
+#
+# Usage: benchmark-icons.py [--repeat N] [--filter TEXT] [--verbose]
+#                           [--save [FILE]] [--compare [FILE]]
+# - Generates icons for a matrix of synthetic source images,
+#   square and non-square and with and without alpha, and generation rules,
+#   for every image type, mask, shape, scale and output size
+# - Reports the fastest time of each stage and the peak memory per case:
+#   decode, pad, scale, mask, composite, encode, hash and write
+# - Saves the results as a baseline to FILE with --save,
+#   which defaults to /.cache/benchmark-icons.json
+# - Compares the results against a baseline with --compare and fails
+#   with a non-zero exit code, when any case became slower or larger
+#
+
+import argparse
+import contextlib
+import ctypes
+import functools
+import gc
+import hashlib
+import importlib.util
+import json
+import os
+import pathlib
+import re
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Optional
+from PIL import Image
+
+import core
+from core import log
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+ICONS_SCRIPT = os.path.join(os.path.dirname(__file__), "2-icons.py")
+DEFAULT_BASELINE_FILE = os.path.join(ROOT_DIR, ".cache", "benchmark-icons.json")
+STAGES = ["decode", "pad", "scale", "mask", "composite", "encode", "hash", "write"]
+# the largest sides of the synthetic source images
+SOURCE_SIZES = [256, 2048]
+# the height of non-square source images relative to their width
+NON_SQUARE_RATIO = 0.6
+# cases are only reported as regressions when they are slower
+# or use more memory than this, to not report noise
+REGRESSION_THRESHOLD = 0.2
+REGRESSION_MIN_SECONDS = 0.002
+REGRESSION_MIN_BYTES = 1024 * 1024
+
+
+def load_icons_module():
+    # the script name is not a valid module name, so it's loaded by path
+    spec = importlib.util.spec_from_file_location("icons", ICONS_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+icons = load_icons_module()
+
+
+class StageTimer:
+    """
+    Measures the exclusive time spent in each stage of the pipeline,
+    by wrapping the functions that implement a stage while another stage runs.
+    Calls that are nested in a wrapped function are counted towards it.
+    """
+
+    def __init__(self):
+        self.times: dict[str, float] = defaultdict(float)
+        self._stack: list[str] = []
+        self._mark = 0.0
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        self._enter(name)
+        try:
+            yield
+        finally:
+            self._exit()
+
+    @contextlib.contextmanager
+    def wrapped(self, owner: any, attribute: str, name: str, within: str):
+        function = getattr(owner, attribute)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if len(self._stack) == 0 or self._stack[-1] != within:
+                return function(*args, **kwargs)
+            with self.stage(name):
+                return function(*args, **kwargs)
+
+        setattr(owner, attribute, wrapper)
+        try:
+            yield
+        finally:
+            setattr(owner, attribute, function)
+
+    def _enter(self, name: str) -> None:
+        now = time.perf_counter()
+        if len(self._stack) > 0:
+            self.times[self._stack[-1]] += now - self._mark
+        self._stack.append(name)
+        self._mark = now
+
+    def _exit(self) -> None:
+        now = time.perf_counter()
+        self.times[self._stack.pop()] += now - self._mark
+        self._mark = now
+
+
+@contextlib.contextmanager
+def instrumented(timer: StageTimer):
+    with contextlib.ExitStack() as stack:
+        # padding happens while the working image is opened
+        stack.enter_context(timer.wrapped(Image, "new", "pad", "decode"))
+        stack.enter_context(timer.wrapped(Image.Image, "paste", "pad", "decode"))
+        # everything else happens while the icon is generated
+        stack.enter_context(timer.wrapped(Image.Image, "resize", "scale", "composite"))
+        stack.enter_context(timer.wrapped(core, "circle_mask", "mask", "composite"))
+        stack.enter_context(timer.wrapped(core, "apply_mask", "mask", "composite"))
+        stack.enter_context(timer.wrapped(icons, "encode_icon", "encode", "composite"))
+        stack.enter_context(timer.wrapped(hashlib, "md5", "hash", "composite"))
+        stack.enter_context(
+            timer.wrapped(core, "write_bytes_atomic", "write", "composite")
+        )
+        yield
+
+
+class Source:
+    def __init__(self, directory: str, size: tuple[int, int], alpha: bool):
+        self.name = f"{size[0]}x{size[1]}-{'alpha' if alpha else 'opaque'}"
+        # sources with alpha are PNG files, like most of the player images,
+        # opaque sources are JPG files, which are decoded with a draft
+        extension = "png" if alpha else "jpg"
+        self.path = os.path.join(directory, f"{self.name}.{extension}")
+        synthesize_image(size, alpha).save(self.path)
+
+
+def synthesize_image(size: tuple[int, int], alpha: bool) -> Image.Image:
+    # gradients produce many colors, so the images are not trivial to encode
+    red = Image.linear_gradient("L").resize(size)
+    green = Image.radial_gradient("L").resize(size)
+    blue = red.transpose(Image.Transpose.ROTATE_90).resize(size)
+    if not alpha:
+        return Image.merge("RGB", (red, green, blue))
+    # a transparent border with a soft edge around an opaque center
+    a = Image.radial_gradient("L").resize(size).point(lambda v: 255 - min(255, v * 2))
+    return Image.merge("RGBA", (red, green, blue, a))
+
+
+def rule_matrix() -> list[icons.GenerationRule]:
+    ImageType = icons.ImageType
+    ImageShape = icons.ImageShape
+    kinds = [
+        ("png", {"image_type": ImageType.PNG}),
+        (
+            "png-optimized",
+            {
+                "image_type": ImageType.PNG,
+                "encoding": icons.EncodingProfile.Optimized,
+            },
+        ),
+        ("jpg", {"image_type": ImageType.JPG}),
+        ("ico", {"image_type": ImageType.ICO}),
+        (
+            "ico-sizes",
+            {"image_type": ImageType.ICO, "ico_sizes": (256, 64, 48, 32, 24, 16)},
+        ),
+        ("webp", {"image_type": ImageType.WEBP}),
+        ("webp-q80", {"image_type": ImageType.WEBP, "quality": 80}),
+    ]
+    shapes = [ImageShape.Square, ImageShape.Circle]
+    borders = [
+        (1.0, icons.Color(icons.ColorCode.Transparent)),
+        (0.68, icons.Color(icons.ColorCode.Black)),
+    ]
+    rules = []
+    for kind, values in kinds:
+        for image_mask in shapes:
+            for output_shape in shapes:
+                for border_scale, background in borders:
+                    for output_size in [64, 512]:
+                        if values["image_type"] == ImageType.ICO:
+                            output_size = None
+                        label = (
+                            f"{kind}/{image_mask.value}-{output_shape.value}"
+                            f"-b{border_scale}-s{output_size}"
+                        )
+                        rule = icons.GenerationRule(
+                            label=label,
+                            image_mask=image_mask,
+                            output_shape=output_shape,
+                            background=background,
+                            border_scale=border_scale,
+                            output_size=output_size,
+                            **values,
+                        )
+                        try:
+                            rule.validate()
+                        except core.ValidationError:
+                            continue
+                        if rule not in rules:
+                            rules.append(rule)
+    return rules
+
+
+def release_memory() -> None:
+    # return freed memory to the system, so that it counts towards the peak
+    # resident set size again when it's allocated by the next case
+    gc.collect()
+    Image.core.clear_cache()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def peak_rss_reset() -> Optional[int]:
+    # resets the peak resident set size of the process and returns it,
+    # which is only supported on Linux
+    try:
+        with open("/proc/self/clear_refs", "wt") as f:
+            f.write("5")
+        return peak_rss()
+    except OSError:
+        return None
+
+
+def peak_rss() -> Optional[int]:
+    with open("/proc/self/status", "rt") as f:
+        match = re.search(r"VmHWM:\s+(\d+) kB", f.read())
+    return int(match.group(1)) * 1024 if match is not None else None
+
+
+def run_case(
+    source: Source, rule: icons.GenerationRule, out_directory: str
+) -> dict[str, float]:
+    timer = StageTimer()
+    working_size = icons.plan_working_sizes([rule], [source.path])[source.path]
+    with instrumented(timer):
+        with timer.stage("decode"):
+            image = icons.open_working_image(source.path, working_size)
+        with timer.stage("composite"):
+            icons.generate_icon(rule, image, out_directory, source.name)
+    return {stage: timer.times[stage] for stage in STAGES}
+
+
+def measure_memory(
+    source: Source, rule: icons.GenerationRule, out_directory: str
+) -> int:
+    """
+    Returns the peak memory usage of a case in bytes. The growth of the
+    resident set size includes memory that Pillow allocates, where supported,
+    Python allocations are traced otherwise.
+    """
+    release_memory()
+    start = peak_rss_reset()
+    tracemalloc.start()
+    try:
+        run_case(source, rule, out_directory)
+        _, traced_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    if start is None:
+        return traced_peak
+    return max(traced_peak, peak_rss() - start)
+
+
+def run_benchmark(
+    repeat: int, pattern: Optional[str], verbose: bool
+) -> dict[str, dict[str, float]]:
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        sources = []
+        for size in SOURCE_SIZES:
+            for alpha in [True, False]:
+                sources.append(Source(directory, (size, size), alpha))
+                non_square = (size, round(size * NON_SQUARE_RATIO))
+                sources.append(Source(directory, non_square, alpha))
+        rules = rule_matrix()
+        out_directory = os.path.join(directory, "out")
+        for source in sources:
+            for rule in rules:
+                name = f"{source.name}/{rule.label}"
+                if pattern is not None and pattern not in name:
+                    continue
+                # the memory is measured first, which also warms up the case
+                peak_bytes = measure_memory(source, rule, out_directory)
+                runs = [run_case(source, rule, out_directory) for _ in range(repeat)]
+                # the fastest run is the least affected by other processes
+                result = {stage: min(run[stage] for run in runs) for stage in STAGES}
+                result["total"] = sum(result[stage] for stage in STAGES)
+                result["peak_bytes"] = peak_bytes
+                results[name] = result
+                if verbose:
+                    log(format_case(name, result))
+    return results
+
+
+def format_case(name: str, result: dict[str, float]) -> str:
+    stages = " ".join(f"{stage} {1000 * result[stage]:.1f}" for stage in STAGES)
+    return (
+        f"{name}: {1000 * result['total']:.1f}ms ({stages}), "
+        f"peak {result['peak_bytes'] / 1024 / 1024:.1f}MB"
+    )
+
+
+def log_summary(results: dict[str, dict[str, float]]) -> None:
+    groups: dict[str, list[dict[str, float]]] = defaultdict(list)
+    for name, result in results.items():
+        source, kind, variant = name.split("/")
+        output_size = variant.split("-")[-1]
+        groups[f"source {source}"].append(result)
+        groups[f"rule {kind}"].append(result)
+        groups[f"rule {kind} {output_size}"].append(result)
+    for group, group_results in sorted(groups.items()):
+        totals = {
+            stage: sum(result[stage] for result in group_results)
+            for stage in STAGES + ["total"]
+        }
+        stages = " ".join(f"{stage} {totals[stage]:.2f}" for stage in STAGES)
+        peak = max(result["peak_bytes"] for result in group_results)
+        log(
+            f"{group}: {totals['total']:.2f}s in {len(group_results)} cases "
+            f"({stages}), peak {peak / 1024 / 1024:.1f}MB"
+        )
+
+
+def compare(
+    results: dict[str, dict[str, float]], baseline: dict[str, dict[str, float]]
+) -> list[str]:
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]
+        seconds = result["total"] - before["total"]
+        if seconds > REGRESSION_MIN_SECONDS and result["total"] > before["total"] * (
+            1 + REGRESSION_THRESHOLD
+        ):
+            stage = max(STAGES, key=lambda s: result[s] - before.get(s, 0.0))
+            regressions.append(
+                f"{name}: {1000 * before['total']:.1f}ms -> "
+                f"{1000 * result['total']:.1f}ms, mostly in {stage}"
+            )
+        size = result["peak_bytes"] - before["peak_bytes"]
+        if size > REGRESSION_MIN_BYTES and result["peak_bytes"] > before[
+            "peak_bytes"
+        ] * (1 + REGRESSION_THRESHOLD):
+            regressions.append(
+                f"{name}: peak {before['peak_bytes'] / 1024 / 1024:.1f}MB -> "
+                f"{result['peak_bytes'] / 1024 / 1024:.1f}MB"
+            )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--filter", default=None)
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--save", nargs="?", const=DEFAULT_BASELINE_FILE)
+    parser.add_argument("--compare", nargs="?", const=DEFAULT_BASELINE_FILE)
+    args = parser.parse_args()
+    baseline = None
+    if args.compare is not None:
+        baseline = core.read_json(args.compare)
+    with core.timed() as t:
+        results = run_benchmark(args.repeat, args.filter, args.verbose)
+    log_summary(results)
+    log(f"Ran {len(results)} cases in {t.elapsed()}")
+    if args.save is not None:
+        pathlib.Path(args.save).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.save, "wt") as f:
+            f.write(json.dumps(results, indent=2))
+    if baseline is not None:
+        regressions = compare(results, baseline)
+        for regression in regressions:
+            log(f"REGRESSION {regression}")
+        if len(regressions) > 0:
+            exit(1)
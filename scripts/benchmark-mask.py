@@ -0,0 +1,135 @@
+#
+# benchmark-mask.py
+# Checks core.apply_mask against the original per-pixel implementation
+# and measures the speedup
+#
+# Input: - (images and masks are synthesized)
+# Output: -
+#
+# Usage: benchmark-mask.py [--count N] [--seed S] [--size S] [--repeat N]
+# - Masks N random RGBA images with random masks and fails with a non-zero
+#   exit code, when the result differs from the original implementation
+# - The original only knew masks that are zero or fully opaque, for masks
+#   with values in between, e.g. the smooth edges of the shared masks,
+#   it checks that pixels where the mask is zero are cleared,
+#   that colors are untouched and that no pixel becomes more opaque
+# - Reports the fastest time of both implementations for masking
+#   an image of S by S pixels with a circle
+#
+
+import argparse
+import random
+import time
+from PIL import Image, ImageDraw
+
+import core
+from core import log
+
+# the largest side of the random images of the parity check
+PARITY_MAX_SIZE = 300
+
+
+def reference_apply_mask(image: Image.Image, mask: Image.Image) -> Image.Image:
+    # the implementation before core.apply_mask worked on the alpha channel
+    if image.size != mask.size:
+        raise ValueError("the image and the mask must have the same size")
+    image_pixels = list(image.getdata())
+    mask_pixels = list(mask.getdata())
+    assert len(image_pixels) == len(mask_pixels)
+    # ensure that transparency in the image is maintained
+    for i in range(len(image_pixels)):
+        if mask_pixels[i] == 0:
+            image_pixels[i] = (
+                image_pixels[i][0],
+                image_pixels[i][1],
+                image_pixels[i][2],
+                mask_pixels[i],
+            )
+    image.putdata(image_pixels)
+    return image
+
+
+def random_image(rng: random.Random, size: tuple[int, int]) -> Image.Image:
+    return Image.frombytes("RGBA", size, rng.randbytes(size[0] * size[1] * 4))
+
+
+def random_mask(
+    rng: random.Random, size: tuple[int, int], values: list[int]
+) -> Image.Image:
+    data = bytes(rng.choices(values, k=size[0] * size[1]))
+    return Image.frombytes("L", size, data)
+
+
+def check_parity(count: int, seed: int) -> list[str]:
+    """
+    Returns a description of every case in which core.apply_mask
+    does not behave like the original implementation.
+    """
+    rng = random.Random(seed)
+    failures = []
+    for i in range(count):
+        size = (
+            rng.randint(1, PARITY_MAX_SIZE),
+            rng.randint(1, PARITY_MAX_SIZE),
+        )
+        image = random_image(rng, size)
+        mask = random_mask(rng, size, [0, 255])
+        expected = reference_apply_mask(image.copy(), mask)
+        actual = core.apply_mask(image.copy(), mask)
+        if actual.tobytes() != expected.tobytes():
+            failures.append(f"case {i}: {size[0]}x{size[1]} with a binary mask")
+        mask = random_mask(rng, size, list(range(256)))
+        actual = core.apply_mask(image.copy(), mask)
+        for pixel, masked, value in zip(
+            image.getdata(), actual.getdata(), mask.getdata()
+        ):
+            if (
+                masked[:3] != pixel[:3]
+                or masked[3] > pixel[3]
+                or (value == 0 and masked[3] != 0)
+                or (value == 255 and masked[3] != pixel[3])
+            ):
+                failures.append(f"case {i}: {size[0]}x{size[1]} with a smooth mask")
+                break
+    return failures
+
+
+def fastest(function, image: Image.Image, mask: Image.Image, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        copy = image.copy()
+        start = time.perf_counter()
+        function(copy, mask)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def run_benchmark(size: int, repeat: int, seed: int) -> tuple[float, float]:
+    image = random_image(random.Random(seed), (size, size))
+    # a hard circle, which both implementations apply the same way
+    mask = Image.new("L", (size, size), 0)
+    ImageDraw.Draw(mask).ellipse((0, 0, size - 1, size - 1), fill=255)
+    reference = fastest(reference_apply_mask, image, mask, repeat)
+    current = fastest(core.apply_mask, image, mask, repeat)
+    return reference, current
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--size", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    failures = check_parity(args.count, args.seed)
+    for failure in failures:
+        log(f"ERROR {failure}")
+    log(f"Checked {args.count} images, {len(failures)} differ")
+    reference, current = run_benchmark(args.size, args.repeat, args.seed)
+    log(
+        f"Masked {args.size}x{args.size} pixels in {current * 1000:.1f}ms, "
+        f"instead of {reference * 1000:.1f}ms with the per-pixel loop "
+        f"({reference / current:.0f}x faster)"
+    )
+    if len(failures) > 0:
+        exit(1)
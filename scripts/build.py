@@ -0,0 +1,356 @@
+#
+# build.py
+# Runs all build stages in a single process
+#
+# Input: /src
+# Output: /out
+# Output artifacts:
+# - File /out/build-manifest.json: The digest of the inputs and the outputs
+#   of every target of the last build
+#
+# Usage: build.py [--force] [--trace FILE] [--no-cache] [--jobs N] [--by-hash]
+#                 [--memory-budget B] [player [player...]]
+# - Runs the numbered scripts in order within one process, so that
+#   the parsed player definitions and the compiled schemas are shared
+#   between the stages and the generated icons are passed to the
+#   players stage directly, instead of being read back from /out/icons.json
+# - Only rebuilds targets whose inputs changed since the last build,
+#   e.g. the icons of a player whose image or overrides changed,
+#   and removes the outputs of players that no longer exist
+# - Rebuilds all targets when --force is passed
+# - Records how long each stage, player, rule and step takes, when
+#   --trace is passed or the BUILD_TRACE_FILE environment variable is set,
+#   and writes it to the given file, which can be opened in chrome://tracing
+#   or https://ui.perfetto.dev, next to a summary of the slowest spans
+# - Generates icons only for the specified players, when any are passed,
+#   and compiles the players files with the icons of the other players
+#   from earlier builds, or not at all, if there are none for some players
+# - Checks the icons of every player against the memory budget, also
+#   the ones that are up to date, when --memory-budget B is passed
+# - The other options are passed to the icons stage, see 2-icons.py
+#
+
+import argparse
+import dataclasses
+import hashlib
+import importlib.util
+import json
+import os
+import pathlib
+import shutil
+import sys
+from typing import Iterable, Optional
+
+import core
+from core import log
+
+SCRIPTS_DIR = os.path.dirname(__file__)
+DOTENV_FILE = os.path.join(SCRIPTS_DIR, ".env")
+VERSION_FILE = os.path.join(SCRIPTS_DIR, "_version.py")
+MANIFEST_FILE = os.path.join(core.ROOT_DIR, "out", "build-manifest.json")
+MANIFEST_VERSION = 1
+
+
+def load_stage(filename: str, name: str):
+    path = os.path.join(SCRIPTS_DIR, filename)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    # registered so that worker processes can find the functions of the module
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+validate_stage = load_stage("1-validate.py", "validate_stage")
+icons_stage = load_stage("2-icons.py", "icons_stage")
+players_stage = load_stage("3-players.py", "players_stage")
+copy_stage = load_stage("4-copy.py", "copy_stage")
+
+
+class BuildManifest:
+    """
+    Records the digest of the inputs and the outputs of each build target,
+    so that targets whose inputs did not change can be skipped
+    and the outputs of targets that no longer exist can be removed.
+    """
+
+    def __init__(self, path: str, force: bool = False):
+        self.path = path
+        self.force = force
+        self.targets: dict[str, dict] = self._read()
+        self._file_digests: dict[str, str] = {}
+
+    def digest(self, filenames: Iterable[str], *values) -> str:
+        # missing files are part of the digest, since creating one
+        # may change the output, e.g. a new image or overrides file
+        digest = hashlib.sha256()
+        digest.update(json.dumps(values).encode("utf-8"))
+        for filename in filenames:
+            digest.update(os.path.relpath(filename, core.ROOT_DIR).encode("utf-8"))
+            digest.update(self._file_digest(filename).encode("utf-8"))
+        return digest.hexdigest()
+
+    def is_current(self, target: str, digest: str) -> bool:
+        entry = self.targets.get(target)
+        if self.force or entry is None or entry["digest"] != digest:
+            return False
+        return all(
+            os.path.exists(os.path.join(core.ROOT_DIR, output))
+            for output in entry["outputs"]
+        )
+
+    def data(self, target: str) -> any:
+        return self.targets[target]["data"]
+
+    def names(self, prefix: str) -> list[str]:
+        return [target for target in self.targets if target.startswith(prefix)]
+
+    def update(
+        self, target: str, digest: str, outputs: list[str], data: any = None
+    ) -> None:
+        self.targets[target] = {
+            "digest": digest,
+            "outputs": [os.path.relpath(output, core.ROOT_DIR) for output in outputs],
+            "data": data,
+        }
+
+    def remove(self, target: str) -> None:
+        del self.targets[target]
+
+    def write(self) -> None:
+        manifest = {"version": MANIFEST_VERSION, "targets": self.targets}
+        pathlib.Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        core.write_bytes_atomic(self.path, json.dumps(manifest).encode("utf-8"))
+
+    def _read(self) -> dict[str, dict]:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            manifest = core.read_json(self.path)
+        except core.ValidationError:
+            return {}
+        if manifest.get("version") != MANIFEST_VERSION:
+            return {}
+        return manifest["targets"]
+
+    def _file_digest(self, filename: str) -> str:
+        if filename not in self._file_digests:
+            if os.path.exists(filename):
+                with open(filename, "rb") as f:
+                    digest = hashlib.sha256(f.read()).hexdigest()
+            else:
+                digest = "missing"
+            self._file_digests[filename] = digest
+        return self._file_digests[filename]
+
+
+def schema_files() -> list[str]:
+    return sorted(str(path) for path in pathlib.Path(core.SCHEMAS_DIR).rglob("*.json"))
+
+
+def icon_result_data(result) -> dict:
+    data = dataclasses.asdict(result)
+    data["image_type"] = result.image_type.value
+    data["image_path"] = os.path.relpath(result.image_path, icons_stage.OUT_ICONS_DIR)
+    return data
+
+
+def icon_result(data: dict):
+    return icons_stage.IconResult(
+        **{
+            **data,
+            "image_type": icons_stage.ImageType(data["image_type"]),
+            "image_path": os.path.join(icons_stage.OUT_ICONS_DIR, data["image_path"]),
+        }
+    )
+
+
+def validate(force: bool = False):
+    # the validator keeps track of changed player definitions itself
+    validate_stage.validate(validate_stage.PLAYERS_DIR, incremental=not force)
+
+
+def icons(
+    manifest: BuildManifest,
+    players: Optional[list[str]] = None,
+    use_cache: bool = True,
+    jobs: int = 1,
+    by_hash: bool = False,
+    memory_budget: Optional[int] = None,
+) -> dict:
+    selected_players = icons_stage.find_players() if players is None else players
+    # the code and configuration that affect the icons of every player
+    shared_inputs = [
+        icons_stage.__file__,
+        core.__file__,
+        DOTENV_FILE,
+        *schema_files(),
+    ]
+    digests: dict[str, Optional[str]] = {}
+    previous = {}
+    for player in selected_players:
+        target = f"icons/{player}"
+        try:
+            inputs = icons_stage.player_icon_inputs(icons_stage.IN_ICONS_DIR, player)
+        except core.ValidationError:
+            # the error is reported when the icons are generated
+            digests[player] = None
+            continue
+        digests[player] = manifest.digest(shared_inputs + inputs, by_hash)
+        # icons are only measured while they are generated
+        if memory_budget is None and manifest.is_current(target, digests[player]):
+            previous[player] = [icon_result(data) for data in manifest.data(target)]
+    if players is None:
+        for target in manifest.names("icons/"):
+            player = target.removeprefix("icons/")
+            if player not in digests:
+                log(f"Removing icons of {player}")
+                icons_stage.remove_player_icons(player)
+                manifest.remove(target)
+    log(f"Reusing icons of {len(previous)} of {len(selected_players)} players")
+    results = icons_stage.generate_all_icons(
+        players=players,
+        cache=icons_stage.IconCache(icons_stage.CACHE_DIR) if use_cache else None,
+        jobs=jobs,
+        hash_store=(
+            icons_stage.HashStore(icons_stage.OUT_BY_HASH_DIR) if by_hash else None
+        ),
+        previous=previous,
+        memory=(
+            icons_stage.MemoryReport(memory_budget)
+            if memory_budget is not None
+            else None
+        ),
+    )
+    for player, player_results in results.items():
+        manifest.update(
+            f"icons/{player}",
+            digests[player],
+            [result.image_path for result in player_results],
+            [icon_result_data(result) for result in player_results],
+        )
+    if players is not None:
+        # the players files contain the icons of every player,
+        # so the icons of the other players are the ones of earlier builds
+        results = {
+            player: (
+                results[player]
+                if player in results
+                else [icon_result(data) for data in manifest.data(f"icons/{player}")]
+            )
+            for player in icons_stage.find_players()
+            if player in results or f"icons/{player}" in manifest.targets
+        }
+    return results
+
+
+def players(manifest: BuildManifest, results: dict):
+    missing = [player for player in icons_stage.find_players() if player not in results]
+    if len(missing) > 0:
+        # the players files would lack their icons otherwise
+        log(f"Skipping players, the icons of {len(missing)} players were never built")
+        return
+    icons = icons_stage.icon_objects(results)
+    player_files = sorted(
+        str(path) for path in pathlib.Path(players_stage.PLAYERS_DIR).rglob("*.yaml")
+    )
+    inputs = [
+        players_stage.__file__,
+        core.__file__,
+        DOTENV_FILE,
+        VERSION_FILE,
+        *schema_files(),
+        *player_files,
+    ]
+    # every players file depends on every player
+    digest = manifest.digest(inputs, icons)
+    outputs = [
+        players_stage.get_output_file(subset, minified)
+        for subset in [None, *players_stage.SUBSET_PLATFORM_PREFIXES]
+        for minified in [False, True]
+    ]
+    if manifest.is_current("players", digest):
+        log("Players are up to date")
+        return
+    players_stage.generate(players_stage.PLAYERS_DIR, icons)
+    manifest.update("players", digest, outputs)
+
+
+def copy(manifest: BuildManifest):
+    static_files = core.read_yaml(copy_stage.STATIC_FILE)
+    inputs = [
+        copy_stage.__file__,
+        core.__file__,
+        DOTENV_FILE,
+        copy_stage.STATIC_FILE,
+        *(copy_stage.static_source_path(file) for file in static_files),
+        *schema_files(),
+    ]
+    digest = manifest.digest(inputs)
+    outputs = [copy_stage.OUT_STATIC_DIR, copy_stage.OUT_SCHEMAS_DIR]
+    if manifest.is_current("copy", digest):
+        log("Static files are up to date")
+        return
+    # files that were removed from the sources would remain otherwise
+    for output in outputs:
+        shutil.rmtree(output, ignore_errors=True)
+    copy_stage.main()
+    manifest.update("copy", digest, outputs)
+
+
+def build(
+    players_filter: Optional[list[str]] = None,
+    use_cache: bool = True,
+    jobs: int = 1,
+    by_hash: bool = False,
+    force: bool = False,
+    memory_budget: Optional[int] = None,
+):
+    manifest = BuildManifest(MANIFEST_FILE, force)
+    with core.timed() as timer, core.span("build", "build"):
+        log("[1/4] Validating players")
+        with core.span("validate", "stage"):
+            validate(force)
+        # the manifest is written after every stage,
+        # so that a failing stage does not discard the work of earlier stages
+        log("[2/4] Generating icons")
+        with core.span("icons", "stage"):
+            results = icons(
+                manifest, players_filter, use_cache, jobs, by_hash, memory_budget
+            )
+            manifest.write()
+        log("[3/4] Compiling players")
+        with core.span("players", "stage"):
+            players(manifest, results)
+            manifest.write()
+        log("[4/4] Copying static files")
+        with core.span("copy", "stage"):
+            copy(manifest)
+            manifest.write()
+        log(f"Build complete in {timer.elapsed()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("players", nargs="*")
+    parser.add_argument("--force", action="store_true")
+    parser.add_argument("--trace", metavar="FILE")
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--by-hash", action="store_true")
+    parser.add_argument("--memory-budget", type=float, metavar="MEGABYTES")
+    args = parser.parse_args()
+    if args.trace is not None:
+        core.enable_tracing(args.trace)
+    build(
+        players_filter=args.players if len(args.players) > 0 else None,
+        use_cache=not args.no_cache,
+        jobs=args.jobs,
+        by_hash=args.by_hash,
+        force=args.force,
+        memory_budget=(
+            round(args.memory_budget * 1024 * 1024)
+            if args.memory_budget is not None
+            else None
+        ),
+    )
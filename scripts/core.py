@@ -1,11 +1,44 @@
+import atexit
+import collections
 import contextlib
 import datetime
+import functools
+import hashlib
 import json
 import jsonschema
+import multiprocessing
+import os
+import pathlib
+import pickle
+import referencing
+import referencing.jsonschema
 import sys
+import time
+import urllib.parse
 import yaml
 from typing import Optional
-from PIL import Image
+from PIL import Image, ImageChops, ImageDraw
+
+# the safe loader of libyaml is several times faster than the one of PyYAML,
+# but it's only available when PyYAML was built with libyaml
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+SCHEMAS_DIR = os.path.join(ROOT_DIR, "src", "schemas")
+CORPUS_CACHE_FILE = os.path.join(ROOT_DIR, ".cache", "corpus.pickle")
+# cached contents are only reused when they were parsed the same way
+CORPUS_CACHE_VERSION = (2, yaml.__version__, YAML_LOADER.__name__)
+
+# how much larger masks are drawn before they are scaled down
+MASK_SUPERSAMPLING = 4
+# the largest side masks are drawn at, larger masks are supersampled less
+MASK_MAX_DRAW_SIZE = 4096
+# how many masks are kept for reuse and the largest size of a kept mask
+MASK_CACHE_SIZE = 128
+MASK_CACHE_MAX_SIZE = 1024
+# spans are recorded and written to this file, when the variable is set
+TRACE_FILE_ENV = "BUILD_TRACE_FILE"
+# how many of the slowest spans of each category are summarized
+TRACE_SUMMARY_SIZE = 10
 
 
 class ValidationError(RuntimeError):
@@ -33,26 +66,149 @@ def read_json(filename):
 
 
 def read_yaml(filename):
-    with open(filename, "rt", encoding="utf-8") as file:
-        try:
-            return yaml.safe_load(file)
-        except yaml.YAMLError as e:
-            error(f"Failed to parse {filename}: {e}")
+    with open(filename, "rb") as file:
+        return parse_yaml(file.read(), filename)
+
+
+def parse_yaml(data: bytes, filename) -> any:
+    try:
+        return yaml.load(data.decode("utf-8"), Loader=YAML_LOADER)
+    except (yaml.YAMLError, UnicodeDecodeError) as e:
+        error(f"Failed to parse {filename}: {e}")
+
+
+def read_yaml_corpus(filenames: list) -> list[any]:
+    """
+    Reads many YAML files and returns their contents in the order of the
+    filenames, but reuses the contents of files that were parsed before,
+    from a cache in /.cache that is keyed by the path of each file
+    and checked against its hash. Every call returns new objects.
+    """
+    global _corpus
+    if _corpus is None:
+        _corpus = _read_corpus_cache()
+    data = []
+    for filename in filenames:
+        with open(filename, "rb") as file:
+            data.append(file.read())
+    digests = [hashlib.sha256(d).hexdigest() for d in data]
+    paths = [os.path.abspath(filename) for filename in filenames]
+    # files are parsed from the same data that was hashed,
+    # so changes while reading can never end up in the cache
+    missing = [
+        i
+        for i, (path, digest) in enumerate(zip(paths, digests))
+        if _corpus.get(path, (None,))[0] != digest
+    ]
+    # parsing all player files with libyaml takes less time
+    # than starting a pool of worker processes would
+    for i in missing:
+        content = parse_yaml(data[i], filenames[i])
+        pickled = pickle.dumps(content, pickle.HIGHEST_PROTOCOL)
+        _corpus[paths[i]] = (digests[i], pickled)
+    # callers may read only some of the files, e.g. the ones that changed,
+    # so only the files that no longer exist are removed
+    removed = [path for path in _corpus if not os.path.exists(path)]
+    for path in removed:
+        del _corpus[path]
+    if len(missing) > 0 or len(removed) > 0:
+        cache = {"version": CORPUS_CACHE_VERSION, "entries": _corpus}
+        pathlib.Path(CORPUS_CACHE_FILE).parent.mkdir(parents=True, exist_ok=True)
+        write_bytes_atomic(CORPUS_CACHE_FILE, pickle.dumps(cache))
+    return [pickle.loads(_corpus[path][1]) for path in paths]
+
+
+# the hash and the pickled contents of parsed YAML files by their path
+_corpus: Optional[dict[str, tuple[str, bytes]]] = None
+
+
+def _read_corpus_cache() -> dict[str, tuple[str, bytes]]:
+    try:
+        with open(CORPUS_CACHE_FILE, "rb") as file:
+            cache = pickle.load(file)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return {}
+    if not isinstance(cache, dict) or cache.get("version") != CORPUS_CACHE_VERSION:
+        return {}
+    return cache["entries"]
+
 
+def write_bytes_atomic(filename, data: bytes):
+    # readers either see the previous file or the complete new file
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp_filename, "wb") as file:
+        file.write(data)
+    os.replace(tmp_filename, filename)
 
-def read_yaml_with_schema(
-    filename,
-    schema: any,
-    resolver: Optional[jsonschema.RefResolver],
-) -> any:
+
+def read_yaml_with_schema(filename, schema: str) -> any:
     content = read_yaml(filename)
     try:
-        jsonschema.validate(instance=content, schema=schema, resolver=resolver)
+        validate_with_schema(content, schema)
     except jsonschema.ValidationError as e:
         error(f"Schema validation error:\n\nFile {filename}:\n\n{e}")
     return content
 
 
+class SchemaRegistry:
+    """
+    Loads all schemas in a directory once, resolves references between them
+    through a single registry and hands out validators that are compiled once.
+    Schemas are named by their path relative to the directory,
+    optionally followed by a JSON pointer to a part of the schema,
+    e.g. "players.schema.json#/properties/icons".
+    """
+
+    def __init__(self, directory: str):
+        self.directory = pathlib.Path(directory).resolve()
+        resources = []
+        for path in sorted(self.directory.rglob("*.schema.json")):
+            contents = read_json(path)
+            # schemas are identified by the URI of their file,
+            # so that relative references resolve against their directory
+            uri = urllib.parse.urljoin(path.as_uri(), contents.get("$id", ""))
+            contents = {**contents, "$id": uri}
+            resource = referencing.Resource.from_contents(
+                contents, default_specification=referencing.jsonschema.DRAFT202012
+            )
+            resources.append((uri, resource))
+        self._registry = referencing.Registry().with_resources(resources).crawl()
+        self._validators: dict[str, jsonschema.protocols.Validator] = {}
+
+    def validator(self, name: str) -> jsonschema.protocols.Validator:
+        if name not in self._validators:
+            path, _, pointer = name.partition("#")
+            uri = self.directory.joinpath(path).as_uri()
+            try:
+                schema = self._registry.contents(uri)
+            except referencing.exceptions.NoSuchResource:
+                error(f"Schema does not exist: {name}")
+            if len(pointer) > 0:
+                # references within the part resolve against its schema
+                schema = {"$ref": f"{uri}#{pointer}"}
+            cls = jsonschema.validators.validator_for(schema)
+            cls.check_schema(schema)
+            self._validators[name] = cls(schema, registry=self._registry)
+        return self._validators[name]
+
+
+@functools.cache
+def schema_registry() -> SchemaRegistry:
+    return SchemaRegistry(SCHEMAS_DIR)
+
+
+def validate_with_schema(instance: any, schema: str) -> None:
+    """
+    Validates an instance against a schema in /src/schemas, e.g. "player.schema.json"
+    or "internal/gen.schema.json", and raises the most relevant error.
+    """
+    validator = schema_registry().validator(schema)
+    with span(schema, "schema-validate"):
+        e = jsonschema.exceptions.best_match(validator.iter_errors(instance))
+    if e is not None:
+        raise e
+
+
 def duplicates(items, window=lambda a: a) -> set[str]:
     s = set()
     return set(x for x in items if window(x) in s or s.add(window(x)))
@@ -78,20 +234,200 @@ def timed():
     yield timer
 
 
+# recorded trace events, or None when tracing is disabled
+_trace_events: Optional[list[dict]] = None
+_null_span = contextlib.nullcontext()
+
+
+class _Span:
+    def __init__(self, name: str, category: str, args: dict):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter_ns()
+        event = {
+            "name": self.name,
+            "cat": self.category,
+            "ph": "X",
+            "ts": self.start / 1000,
+            "dur": (end - self.start) / 1000,
+            "pid": os.getpid(),
+            "tid": 0,
+        }
+        if len(self.args) > 0:
+            event["args"] = self.args
+        _trace_events.append(event)
+
+
+def span(name: str, category: str, **args):
+    """
+    Returns a context manager that records the time spent within it
+    as a span of a category, e.g. "stage", "player", "rule" or "step",
+    when tracing is enabled, and that does nothing otherwise.
+    """
+    if _trace_events is None:
+        return _null_span
+    return _Span(name, category, args)
+
+
+def enable_tracing(filename: str) -> None:
+    """
+    Records spans and writes them to a file in the Chrome trace event format
+    when the process exits, next to a summary of the slowest spans.
+    Worker processes inherit the setting, see call_traced().
+    """
+    global _trace_events
+    _trace_events = []
+    os.environ[TRACE_FILE_ENV] = filename
+    if multiprocessing.parent_process() is None:
+        atexit.register(write_trace, filename)
+
+
+def call_traced(function, *args) -> tuple[any, list[dict]]:
+    """
+    Calls a function in a worker process and returns its result
+    together with the trace events it recorded, for merge_trace().
+    """
+    global _trace_events
+    if _trace_events is None:
+        return function(*args), []
+    _trace_events = []
+    result = function(*args)
+    events, _trace_events = _trace_events, []
+    return result, events
+
+
+def merge_trace(events: list[dict]) -> None:
+    if _trace_events is not None:
+        _trace_events.extend(events)
+
+
+def write_trace(filename: str) -> None:
+    trace = {"traceEvents": _trace_events, "displayTimeUnit": "ms"}
+    pathlib.Path(filename).parent.mkdir(parents=True, exist_ok=True)
+    write_bytes_atomic(filename, json.dumps(trace).encode("utf-8"))
+    log(f"Wrote {len(_trace_events)} trace events to {filename}")
+    durations: dict[str, dict[str, float]] = collections.defaultdict(
+        lambda: collections.defaultdict(float)
+    )
+    for event, name in zip(_trace_events, summary_names(_trace_events)):
+        durations[event["cat"]][name] += event["dur"]
+    # categories with the most time first, e.g. the build before its stages
+    categories = sorted(
+        durations.items(), key=lambda item: sum(item[1].values()), reverse=True
+    )
+    for category, names in categories:
+        slowest = sorted(names.items(), key=lambda item: item[1], reverse=True)
+        log(f"Slowest spans of category {category}:")
+        for name, duration in slowest[:TRACE_SUMMARY_SIZE]:
+            log(f"{duration / 1000:10.1f}ms  {name}")
+
+
+def summary_names(events: list[dict]) -> list[str]:
+    """
+    Returns the name of each event in the summary, which includes the player
+    and the rule for rules and steps, e.g. "vlc/logo-128/encode", so that
+    the slowest ones are not summed up over all players.
+    """
+    names = [event["name"] for event in events]
+    # steps are only linked to their rule by being nested in its span
+    order = sorted(
+        range(len(events)),
+        key=lambda i: (events[i]["pid"], events[i]["ts"], -events[i]["dur"]),
+    )
+    rules: list[int] = []
+    for i in order:
+        event = events[i]
+        while len(rules) > 0 and (
+            events[rules[-1]]["pid"] != event["pid"]
+            or events[rules[-1]]["ts"] + events[rules[-1]]["dur"] <= event["ts"]
+        ):
+            rules.pop()
+        if event["cat"] == "rule" and "player" in event.get("args", {}):
+            names[i] = f'{event["args"]["player"]}/{event["name"]}'
+            rules.append(i)
+        elif event["cat"] == "step" and len(rules) > 0:
+            names[i] = f'{names[rules[-1]]}/{event["name"]}'
+    return names
+
+
+if os.environ.get(TRACE_FILE_ENV):
+    enable_tracing(os.environ[TRACE_FILE_ENV])
+
+
 def apply_mask(image: Image.Image, mask: Image.Image) -> Image.Image:
     if image.size != mask.size:
         raise ValueError("the image and the mask must have the same size")
-    image_pixels = list(image.getdata())
-    mask_pixels = list(mask.getdata())
-    assert len(image_pixels) == len(mask_pixels)
-    # ensure that transparency in the image is maintained
-    for i in range(len(image_pixels)):
-        if mask_pixels[i] == 0:
-            image_pixels[i] = (
-                image_pixels[i][0],
-                image_pixels[i][1],
-                image_pixels[i][2],
-                mask_pixels[i],
-            )
-    image.putdata(image_pixels)
+    if image.mode != "RGBA":
+        raise ValueError("the image must be an RGBA image")
+    # ensure that transparency in the image is maintained,
+    # pixels where the mask is zero become fully transparent
+    # and the alpha of all other pixels is scaled by the mask
+    with span("mask", "step"):
+        if mask.mode != "L":
+            mask = mask.convert("L")
+        alpha = ImageChops.multiply(image.getchannel("A"), mask)
+        image.putalpha(alpha)
     return image
+
+
+def circle_mask(size: int) -> Image.Image:
+    """
+    Returns a smooth circle mask with the given diameter.
+    The mask is shared with other callers and must not be modified.
+    """
+    return shape_mask("circle", (size, size))
+
+
+def rounded_corners_mask(size: tuple[int, int], radius: int) -> Image.Image:
+    """
+    Returns a smooth mask of a rectangle with rounded corners.
+    The mask is shared with other callers and must not be modified.
+    """
+    return shape_mask("rounded-rectangle", size, radius)
+
+
+def shape_mask(shape: str, size: tuple[int, int], radius: int = 0) -> Image.Image:
+    if max(size) > MASK_CACHE_MAX_SIZE:
+        return _draw_mask(shape, size, radius)
+    return _cached_mask(shape, size, radius)
+
+
+@functools.lru_cache(maxsize=MASK_CACHE_SIZE)
+def _cached_mask(shape: str, size: tuple[int, int], radius: int) -> Image.Image:
+    return _draw_mask(shape, size, radius)
+
+
+def mask_supersampling(size: tuple[int, int]) -> int:
+    return max(1, min(MASK_SUPERSAMPLING, MASK_MAX_DRAW_SIZE // max(size)))
+
+
+def mask_footprint(side: int) -> int:
+    """
+    Returns the bytes a square mask needs while it is drawn,
+    which is the drawing at its supersampled size and the mask itself.
+    """
+    factor = mask_supersampling((side, side))
+    return (side * factor) ** 2 + side**2
+
+
+def _draw_mask(shape: str, size: tuple[int, int], radius: int) -> Image.Image:
+    # draw the shape larger and scale it down, so that its edges are smooth
+    factor = mask_supersampling(size)
+    large_size = (size[0] * factor, size[1] * factor)
+    mask = Image.new("L", large_size, 0)
+    mask_draw = ImageDraw.Draw(mask)
+    box = (0, 0, large_size[0] - 1, large_size[1] - 1)
+    if shape == "circle":
+        mask_draw.ellipse(box, fill=255)
+    elif shape == "rounded-rectangle":
+        mask_draw.rounded_rectangle(box, radius * factor, fill=255)
+    else:
+        raise ValueError(f"unknown mask shape: {shape}")
+    return mask.resize(size, Image.Resampling.BOX)
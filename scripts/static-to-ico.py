@@ -1,6 +1,6 @@
 import pathlib
 import os
-from PIL import Image, ImageDraw
+from PIL import Image
 
 import core
 from core import error, warn
@@ -11,18 +11,9 @@ SRC_DIR = os.path.join(ROOT_DIR, "src")
 OUT_DIR = os.path.join(ROOT_DIR, "out", "static-icos")
 
 
-# Source: https://stackoverflow.com/a/11291419
 def add_corners(im, rad):
-    circle = Image.new("L", (rad * 2, rad * 2), 0)
-    draw = ImageDraw.Draw(circle)
-    draw.ellipse((0, 0, rad * 2 - 1, rad * 2 - 1), fill=255)
-    alpha = Image.new("L", im.size, 255)
-    w, h = im.size
-    alpha.paste(circle.crop((0, 0, rad, rad)), (0, 0))
-    alpha.paste(circle.crop((0, rad, rad, rad * 2)), (0, h - rad))
-    alpha.paste(circle.crop((rad, 0, rad * 2, rad)), (w - rad, 0))
-    alpha.paste(circle.crop((rad, rad, rad * 2, rad * 2)), (w - rad, h - rad))
-    core.apply_mask(im, alpha)  # slower, but preserves original transparency
+    # preserves original transparency
+    core.apply_mask(im, core.rounded_corners_mask(im.size, rad))
     return im
 
 
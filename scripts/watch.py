@@ -0,0 +1,216 @@
+#
+# watch.py
+# Rebuilds the output whenever a source file changes
+#
+# Input: /src
+# Output: /out
+#
+# Usage: watch.py [--poll]
+# - Runs an incremental build on start and after every change in /src,
+#   within the same process, so that the compiled schemas and the parsed
+#   player definitions stay loaded between builds, see build.py
+# - Waits until there have been no changes for a moment before building,
+#   so that a burst of saves results in a single build
+# - Keeps watching when a build fails, e.g. because of a corrupt image
+#   or a file that was saved in the middle of the build
+# - Watches for changes with inotify on Linux and by polling otherwise,
+#   or when --poll is passed
+#
+
+import argparse
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+import traceback
+from typing import Optional
+
+import build
+import core
+from core import log
+
+SRC_DIR = os.path.join(core.ROOT_DIR, "src")
+# how long to wait for more changes after a change, before building
+DEBOUNCE_SECONDS = 0.1
+POLL_INTERVAL_SECONDS = 0.25
+
+# see inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = os.O_CLOEXEC
+INOTIFY_MASK = (
+    IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+)
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    """
+    Watches a directory tree for changes with inotify,
+    including directories that are created while watching.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._directories: dict[int, str] = {}
+        self._add_tree(root)
+
+    def wait(self, timeout: Optional[float] = None) -> set[str]:
+        """
+        Returns the paths that changed, once there are any,
+        or an empty set, if nothing changed within the timeout.
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if len(readable) == 0:
+            return set()
+        data = os.read(self._fd, 65536)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, anything might have changed
+                changed.add(self.root)
+                continue
+            if mask & IN_IGNORED:
+                self._directories.pop(wd, None)
+                continue
+            directory = self._directories.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_tree(path)
+            changed.add(path)
+        return changed
+
+    def _add_tree(self, root: str) -> None:
+        for directory, _, _ in os.walk(root):
+            wd = self._libc.inotify_add_watch(
+                self._fd, os.fsencode(directory), INOTIFY_MASK
+            )
+            if wd >= 0:
+                self._directories[wd] = directory
+
+
+class PollingWatcher:
+    """
+    Watches a directory tree for changes by comparing the modification time
+    and the size of all files in regular intervals.
+    """
+
+    def __init__(self, root: str, interval: float = POLL_INTERVAL_SECONDS):
+        self.root = root
+        self.interval = interval
+        self._snapshot = self._scan()
+
+    def wait(self, timeout: Optional[float] = None) -> set[str]:
+        """
+        Returns the paths that changed, once there are any,
+        or an empty set, if nothing changed within the timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            snapshot = self._scan()
+            changed = set(
+                path
+                for path in snapshot.keys() | self._snapshot.keys()
+                if snapshot.get(path) != self._snapshot.get(path)
+            )
+            self._snapshot = snapshot
+            if len(changed) > 0:
+                return changed
+            if deadline is None:
+                time.sleep(self.interval)
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return set()
+            time.sleep(min(self.interval, remaining))
+
+    def _scan(self) -> dict[str, tuple[int, int]]:
+        snapshot = {}
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+
+def create_watcher(root: str, poll: bool = False):
+    if not poll:
+        try:
+            return InotifyWatcher(root)
+        except (AttributeError, OSError) as e:
+            log(f"inotify is not available, falling back to polling: {e}")
+    return PollingWatcher(root)
+
+
+def run_build() -> None:
+    try:
+        build.build()
+    except core.ValidationError as e:
+        log(f"ERROR {e}")
+        log("Build failed, waiting for changes")
+    except SystemExit:
+        # the failing stage reported the error already
+        log("Build failed, waiting for changes")
+    except Exception:
+        # e.g. a corrupt image or a file that was saved during the build
+        log(traceback.format_exc().rstrip())
+        log("Build failed, waiting for changes")
+
+
+def watch(poll: bool = False) -> None:
+    watcher = create_watcher(SRC_DIR, poll)
+    log(f"Watching {SRC_DIR} with {type(watcher).__name__}")
+    run_build()
+    while True:
+        changed = watcher.wait()
+        while True:
+            more = watcher.wait(DEBOUNCE_SECONDS)
+            if len(more) == 0:
+                break
+            changed |= more
+        log()
+        for path in sorted(changed)[:5]:
+            log(f"Changed {os.path.relpath(path, core.ROOT_DIR)}")
+        if len(changed) > 5:
+            log(f"... and {len(changed) - 5} more")
+        if any(
+            path.startswith(core.SCHEMAS_DIR) or core.SCHEMAS_DIR.startswith(path)
+            for path in changed
+        ):
+            # schemas are compiled once and kept for the next build otherwise
+            core.schema_registry.cache_clear()
+        run_build()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--poll", action="store_true")
+    args = parser.parse_args()
+    try:
+        watch(args.poll)
+    except KeyboardInterrupt:
+        pass
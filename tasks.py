@@ -1,4 +1,4 @@
-from invoke import task
+from invoke import call, task
 from invoke.context import Context
 
 import os
@@ -24,17 +24,6 @@ DEPLOY_REPO = os.getenv("DEPLOY_REPO") or "git@github.com:music-presence/live.gi
 DEPLOY_BRANCH = "master"
 
 
-def find_ordered_scripts() -> list[pathlib.Path]:
-    return sorted(
-        [
-            path
-            for path in pathlib.Path(SCRIPTS_DIR).glob("*.py")
-            if len(path.stem) > 0 and path.stem[0].isdigit()
-        ],
-        key=lambda p: p.stem,
-    )
-
-
 # https://stackoverflow.com/a/58878271
 def clear_directory(path: str):
     for root, dirs, files in os.walk(path):
@@ -48,30 +37,48 @@ def clear_directory(path: str):
 @task(aliases=["i"])
 def build_player_icons(c: Context, player: str):
     print(f'Building player "{player}"')
-    if os.path.exists(OUTPUT_DIR):
-        clear_directory(OUTPUT_DIR)
+    # only the icons of this player are replaced
     script = os.path.join(SCRIPTS_DIR, "2-icons.py")
     c.run(f'python -u "{script}" "{player}"')
 
 
 @task(aliases=["b"])
-def build(c: Context, player: Optional[str] = None):
+def build(
+    c: Context,
+    player: Optional[str] = None,
+    force: bool = False,
+    memory_budget: Optional[float] = None,
+):
     print("Building players")
-    if os.path.exists(OUTPUT_DIR):
-        print("Removing existing output directory", file=sys.stderr)
-        clear_directory(OUTPUT_DIR)
-    scripts = find_ordered_scripts()
-    for i, script in enumerate(scripts):
-        print_path = pathlib.PurePosixPath(script.relative_to(CWD))
-        print(f"[{i+1}/{len(scripts)}] Running {print_path}", file=sys.stderr)
-        if player is not None:
-            c.run(f'python -u "{script}" "{player}"')
-        else:
-            c.run(f'python -u "{script}"')
-    print("Build complete", file=sys.stderr)
+    args = []
+    if force:
+        if os.path.exists(OUTPUT_DIR):
+            print("Removing existing output directory", file=sys.stderr)
+            clear_directory(OUTPUT_DIR)
+        args.append("--force")
+    if memory_budget is not None:
+        # fails when generating an icon needs more megabytes than this
+        args.append(f"--memory-budget {memory_budget}")
+    if player is not None:
+        args.append(f'"{player}"')
+    # all stages run in one process and only rebuild what changed,
+    # see scripts/build.py
+    script = os.path.join(SCRIPTS_DIR, "build.py")
+    c.run(" ".join([f'python -u "{script}"', *args]))
     print("", file=sys.stderr)
 
 
+@task(aliases=["w"])
+def watch(c: Context, poll: bool = False):
+    print("Watching for changes")
+    # rebuilds incrementally in a single process, see scripts/watch.py
+    script = os.path.join(SCRIPTS_DIR, "watch.py")
+    if poll:
+        c.run(f'python -u "{script}" --poll')
+    else:
+        c.run(f'python -u "{script}"')
+
+
 def get_players_from_deployment(directory: str) -> Optional[dict[str, str]]:
     input_path = os.path.join(directory, "players.json")
     if not os.path.exists(input_path):
@@ -110,7 +117,8 @@ def copy_tree_append_only(src, dst):
             shutil.copy(src_file, dst_file)
 
 
-@task(pre=[build], aliases=["d"])
+# deployments are always built from scratch
+@task(pre=[call(build, force=True)], aliases=["d"])
 def deploy(c: Context):
     print("Deploying players", file=sys.stderr)
     if os.path.exists(BUILD_DIR):